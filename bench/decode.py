@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures proto.decodepacket on a few realistic responses.
+
+import sys
+import time
+import getopt
+
+from ldd import proto, rec
+
+n = 5000
+opts, args = getopt.getopt(sys.argv[1:], "n:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+
+def query(name, rtype):
+    pkt = proto.packet(flags = ["recurse"])
+    pkt.addq(rec.rrhead(name, rtype))
+    return pkt
+
+def answer(name, rtype, *args):
+    return rec.rr((name, rtype), 3600, rec.rrdata(rtype, *args))
+
+# A single A answer
+resp1 = proto.responsefor(query("www.example.com.", "A"))
+resp1.addan(answer("www.example.com.", "A", "192.0.2.1"))
+
+# A referral from a TLD server: NS set plus glue
+resp2 = proto.responsefor(query("www.example.com.", "A"))
+for i in xrange(6):
+    resp2.addau(answer("example.com.", "NS", "ns%i.example.com." % i))
+    resp2.addad(answer("ns%i.example.com." % i, "A", "192.0.2.%i" % (10 + i)))
+    resp2.addad(answer("ns%i.example.com." % i, "AAAA", "2001:db8::%x" % (10 + i)))
+
+# A CNAME chain with an MX set and an SOA
+resp3 = proto.responsefor(query("mail.example.org.", "MX"))
+resp3.addan(answer("mail.example.org.", "CNAME", "mx.hosting.example.net."))
+for i in xrange(5):
+    resp3.addan(answer("mx.hosting.example.net.", "MX", 10 * i, "mx%i.hosting.example.net." % i))
+resp3.addau(answer("hosting.example.net.", "SOA", "ns1.hosting.example.net.", "hostmaster.hosting.example.net.", 2006010101, 3600, 600, 86400, 300))
+
+for title, resp in [("single A", resp1), ("referral", resp2), ("MX chain", resp3)]:
+    data = resp.encode()
+    start = time.time()
+    for i in xrange(n):
+        proto.decodepacket(data)
+    end = time.time()
+    print "%-10s (%3i bytes, %2i RRs): %.0f packets/s" % (title, len(data), len(resp.allrrs()), n / (end - start))
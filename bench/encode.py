@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures packet.encode on a single-answer and a 50-RR response.
+
+import sys
+import time
+import getopt
+
+from ldd import proto, rec
+
+n = 2000
+opts, args = getopt.getopt(sys.argv[1:], "n:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+
+def query(name, rtype):
+    pkt = proto.packet(flags = ["recurse"])
+    pkt.addq(rec.rrhead(name, rtype))
+    return pkt
+
+def answer(name, rtype, *args):
+    return rec.rr((name, rtype), 3600, rec.rrdata(rtype, *args))
+
+# A single A answer
+resp1 = proto.responsefor(query("www.example.com.", "A"))
+resp1.addan(answer("www.example.com.", "A", "192.0.2.1"))
+
+# 50 RRs: an NS set with glue and a spread of names in a few zones
+resp2 = proto.responsefor(query("www.example.com.", "A"))
+for i in xrange(10):
+    resp2.addan(answer("www.example.com.", "A", "192.0.2.%i" % i))
+    resp2.addan(answer("www.example.com.", "MX", 10 * i, "mx%i.mail.example.net." % i))
+for i in xrange(10):
+    resp2.addau(answer("example.com.", "NS", "ns%i.dns.example.org." % i))
+    resp2.addad(answer("ns%i.dns.example.org." % i, "A", "198.51.100.%i" % i))
+    resp2.addad(answer("ns%i.dns.example.org." % i, "AAAA", "2001:db8::%x" % i))
+
+for title, resp in [("single A", resp1), ("50 RRs", resp2)]:
+    data = resp.encode()
+    start = time.time()
+    for i in xrange(n):
+        resp.encode()
+    end = time.time()
+    print "%-10s (%4i bytes, %2i RRs): %.0f packets/s" % (title, len(data), len(resp.allrrs()), n / (end - start))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures how many query packets per second the socket listener can
+# decode and hand to the request queue. The dispatchers are not
+# started; the queue is replaced by a counter.
+
+import sys
+import time
+import socket
+import getopt
+import threading
+
+from ldd import server, proto, rec
+
+nsocks = 16
+duration = 5.0
+opts, args = getopt.getopt(sys.argv[1:], "n:t:")
+for o, a in opts:
+    if o == "-n":
+        nsocks = int(a)
+    if o == "-t":
+        duration = float(a)
+
+class countserver(server.dnsserver):
+    def __init__(self):
+        server.dnsserver.__init__(self)
+        self.count = 0
+
+    def queuereqs(self, reqs):
+        self.count += len(reqs)
+
+srv = countserver()
+addrs = []
+for i in xrange(nsocks):
+    sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sk.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    sk.bind(("127.0.0.1", 0))
+    srv.addsock(socket.AF_INET, sk)
+    addrs += [sk.getsockname()]
+
+lst = server.dnsserver.socklistener(srv)
+lst.setDaemon(True)
+lst.start()
+
+pkt = proto.packet(flags = ["recurse"])
+pkt.addq(rec.rrhead("www.example.com.", "A"))
+query = pkt.encode()
+
+alive = True
+def blast():
+    ck = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    i = 0
+    while alive:
+        # Stay a bit ahead of the listener without overflowing it
+        if i - srv.count < 256:
+            ck.sendto(query, addrs[i % len(addrs)])
+            i += 1
+        else:
+            time.sleep(0)
+sender = threading.Thread(target = blast)
+sender.setDaemon(True)
+sender.start()
+
+time.sleep(0.5)
+start, c1 = time.time(), srv.count
+time.sleep(duration)
+end, c2 = time.time(), srv.count
+alive = False
+lst.stop()
+lst.join()
+print "%i sockets: %.0f packets/s" % (nsocks, (c2 - c1) / (end - start))
+print "listener stats: %r" % lst.stats()
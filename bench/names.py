@@ -0,0 +1,44 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures dn.fromstring on repeated and unique names of a few shapes.
+
+import sys
+import time
+import getopt
+
+from ldd import dn
+
+n = 100000
+opts, args = getopt.getopt(sys.argv[1:], "n:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+
+def run(title, names):
+    start = time.time()
+    for name in names:
+        dn.fromstring(name)
+    end = time.time()
+    print "%-20s %.0f names/s" % (title, len(names) / (end - start))
+
+run("short, repeated", ["www.example.com."] * n)
+run("short, unique", ["h%i.example.com." % i for i in xrange(n)])
+run("relative, unique", ["h%i.example" % i for i in xrange(n)])
+run("long, unique", ["h%i.a.b.c.d.e.f.g.example.com." % i for i in xrange(n)])
+run("max length, unique", [("h%i." % i) + "x" * 60 + "." + "y" * 60 + "." + "z" * 60 + ".example.com." for i in xrange(n / 10)])
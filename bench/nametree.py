@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures dn.nametree on a large number of names spread over a few
+# thousand zones.
+
+import sys
+import time
+import getopt
+import resource
+
+from ldd import dn
+
+n = 1000000
+opts, args = getopt.getopt(sys.argv[1:], "n:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+
+def report(title, count, start):
+    print "%-10s %.0f ops/s" % (title, count / (time.time() - start))
+
+zones = [dn.domainname(["zone%i" % i, "example", "com"], True) for i in xrange(max(n / 500, 1))]
+names = [dn.domainname(["h%i" % i, "sub%i" % (i % 7)]) + zones[i % len(zones)] for i in xrange(n)]
+below = [dn.domainname(["x"]) + name for name in names[:n / 10]]
+
+tree = dn.nametree()
+base = rss()
+start = time.time()
+for name in zones:
+    tree.add(name, None)
+for name in names:
+    tree.add(name, None)
+report("insert", len(zones) + n, start)
+print "%-10s %.0f bytes/name" % ("memory", float(rss() - base) / (len(zones) + n))
+
+start = time.time()
+for name in names:
+    tree.get(name)
+report("lookup", n, start)
+
+start = time.time()
+for name in below:
+    tree.longest(name)
+report("longest", len(below), start)
+
+start = time.time()
+c = 0
+for zone in zones[:100]:
+    for name, value in tree.subtree(zone):
+        c += 1
+report("iterate", c, start)
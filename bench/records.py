@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures the memory and construction and lookup throughput of a
+# large number of in-memory A records, as a cache or zone would hold.
+
+import sys
+import time
+import getopt
+import resource
+
+from ldd import rec, dn
+
+n = 1000000
+opts, args = getopt.getopt(sys.argv[1:], "n:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+
+def rss():
+    return int(open("/proc/self/statm").read().split()[1]) * resource.getpagesize()
+
+# Names and addresses are made up front, so that only the records
+# themselves are measured.
+names = [dn.domainname(["h%i" % i, "example", "com"], True) for i in xrange(n)]
+addrs = ["\x0a%s" % chr(i & 0xff) + "\x00\x01" for i in xrange(n)]
+
+base = rss()
+start = time.time()
+rrs = []
+for i in xrange(n):
+    rrs.append(rec.rr(rec.rrhead(names[i], "A"), 3600, rec.rrdata("A", addrs[i])))
+end = time.time()
+mem = rss() - base
+print "build:  %.0f records/s, %.0f bytes/record" % (n / (end - start), float(mem) / n)
+
+start = time.time()
+c = 0
+for rr in rrs:
+    if rr.head.istype("A") and rr.data.istype("A"):
+        c += 1
+end = time.time()
+print "istype: %.0f records/s" % (n / (end - start))
+
+start = time.time()
+for rr in rrs:
+    rr.data["address"]
+    rec.rtypebyid(rr.head.rtype)
+end = time.time()
+print "access: %.0f records/s" % (n / (end - start))
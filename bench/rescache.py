@@ -0,0 +1,136 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures rescache.cacheresolver against an upstream that answers
+# after -l seconds with TTLs of up to -T seconds, over a stream of
+# queries for a skewed set of names, spread over -t threads. The locks created by the resolver are
+# instrumented, to show how long they are held and how often they
+# are contended.
+
+import sys
+import time
+import random
+import getopt
+import threading
+
+from ldd import rescache, proto, rec, dn
+
+n = 50000
+nnames = 20000
+alpha = 1.0
+maxentries = None
+nthreads = 1
+latency = 0.0
+ttl = 600
+opts, args = getopt.getopt(sys.argv[1:], "n:N:a:m:t:l:T:")
+for o, a in opts:
+    if o == "-n":
+        n = int(a)
+    if o == "-N":
+        nnames = int(a)
+    if o == "-a":
+        alpha = float(a)
+    if o == "-m":
+        maxentries = int(a)
+    if o == "-t":
+        nthreads = int(a)
+    if o == "-l":
+        latency = float(a)
+    if o == "-T":
+        ttl = int(a)
+
+reallock = threading.Lock
+locks = []
+
+class timedlock(object):
+    def __init__(self):
+        self.lock = reallock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.held = 0.0
+        locks.append(self)
+
+    def acquire(self):
+        if not self.lock.acquire(False):
+            self.lock.acquire()
+            self.contended += 1
+        self.since = time.time()
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self.held += time.time() - self.since
+        self.lock.release()
+
+class upstream:
+    def __init__(self):
+        self.queries = 0
+        self.background = 0
+        self.lock = threading.Lock()
+
+    def squery(self, name, rtype, deadline = None):
+        self.lock.acquire()
+        self.queries += 1
+        if isinstance(threading.currentThread(), getattr(rescache, "refresher", ())):
+            self.background += 1
+        self.lock.release()
+        if latency > 0:
+            time.sleep(latency)
+        pkt = proto.packet()
+        pkt.addq(rec.rrhead(name, rtype))
+        resp = proto.responsefor(pkt)
+        resp.addan(rec.rr((name, rtype), random.randint(ttl // 10, ttl), rec.rrdata("A", "192.0.2.1")))
+        resp.addau(rec.rr(("example.com.", "NS"), 3600, rec.rrdata("NS", "ns.example.com.")))
+        return resp
+
+random.seed(0)
+names = [dn.fromstring("h%i.example.com." % i) for i in xrange(nnames)]
+# A roughly Zipf-like choice of names
+queries = [names[min(int(random.paretovariate(alpha)) - 1, nnames - 1)] for i in xrange(n)]
+
+up = upstream()
+threading.Lock = timedlock
+try:
+    if maxentries is None:
+        res = rescache.cacheresolver(up)
+    else:
+        res = rescache.cacheresolver(up, maxentries = maxentries)
+finally:
+    threading.Lock = reallock
+
+def run(queries):
+    for name in queries:
+        pkt = proto.packet()
+        pkt.addq(rec.rrhead(name, "A"))
+        res.resolve(pkt)
+
+threads = [threading.Thread(target = run, args = (queries[i::nthreads],)) for i in xrange(nthreads)]
+start = time.time()
+for th in threads:
+    th.start()
+for th in threads:
+    th.join()
+end = time.time()
+print "%.0f queries/s, %i upstream queries (%i in the background), %i threads" % (n / (end - start), up.queries, up.background, nthreads)
+acq = sum([l.acquisitions for l in locks])
+cont = sum([l.contended for l in locks])
+held = sum([l.held for l in locks])
+print "%i locks, %i acquisitions, %i contended (%.2f%%)" % (len(locks), acq, cont, cont * 100.0 / acq)
+print "%.2f us held per acquisition, %.2f s in total" % (held * 1e6 / acq, held)
+if hasattr(res, "stats"):
+    print res.stats()
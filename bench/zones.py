@@ -0,0 +1,46 @@
+#!/usr/bin/python
+#    ldd - DNS implementation in Python
+#    Copyright (C) 2006 Fredrik Tolf <fredrik@dolda2000.com>
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+# Measures zone selection with many zones on one server.
+
+import sys
+import time
+import getopt
+
+from ldd import server, dn
+
+nzones = 5000
+nlookups = 20000
+opts, args = getopt.getopt(sys.argv[1:], "z:n:")
+for o, a in opts:
+    if o == "-z":
+        nzones = int(a)
+    if o == "-n":
+        nlookups = int(a)
+
+srv = server.dnsserver()
+for i in xrange(nzones):
+    srv.addzone(server.zone("zone%i.example.com" % i, server.handler()))
+srv.addzone(server.zone("example.com", server.handler()))
+names = [dn.fromstring("www.sub.Zone%i.example.com." % (i % (nzones * 2))) for i in xrange(nlookups)]
+
+start = time.time()
+for name in names:
+    srv.findzone(name)
+end = time.time()
+print "%i zones: %.0f lookups/s" % (nzones, nlookups / (end - start))
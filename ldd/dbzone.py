@@ -27,6 +27,9 @@ import dn
 
 logger = logging.getLogger("ldd.dbzone")
 
+# Not a valid name key; bumped on every write, for generation()
+genkey = "\0generation"
+
 class dnsdb:
     def __init__(self, dbdir, dbfile):
         self.env = bsddb.db.DBEnv()
@@ -70,8 +73,15 @@ class dnsdb:
             return None
         return self.decoderecord(name, record)
 
+    def generation(self):
+        return int(self.db.get(genkey) or 0)
+
+    def bump(self):
+        self.db.put(genkey, str(self.generation() + 1))
+
     def set(self, name, rrset):
         self.db.put(str(name), self.encoderecord(rrset))
+        self.bump()
         return True
     
     def hasname(self, name):
@@ -83,6 +93,7 @@ class dnsdb:
             self.db.delete(str(name))
         except bsddb.db.DBNotFoundError:
             return False
+        self.bump()
         return True
 
     def rmrtype(self, name, rtype):
@@ -110,22 +121,25 @@ class dnsdb:
         ret = cursor.first()
         if ret is not None:
             name, record = ret
-            yield name
+            if name != genkey:
+                yield name
             while True:
                 ret = cursor.next()
                 if ret is None:
                     break
                 name, record = ret
-                yield name
+                if name != genkey:
+                    yield name
         cursor.close()
 
 def rootify(rrset, origin):
     for rr in rrset:
         if not rr.head.name.rooted:
             rr.head.name += origin
-        for dname, dval in rr.data.rdata.items():
+        for dname in rr.data:
+            dval = rr.data[dname]
             if isinstance(dval, dn.domainname) and not dval.rooted:
-                rr.data.rdata[dname] += origin
+                rr.data[dname] = dval + origin
 
 class dbhandler(server.handler):
     def __init__(self, dbdir, dbfile):
@@ -133,6 +147,9 @@ class dbhandler(server.handler):
         self.doddns = False
         self.authkeys = []
 
+    def generation(self):
+        return self.db.generation()
+
     def handle(self, query, pkt, origin):
         resp = proto.responsefor(pkt)
         if pkt.opcode == proto.QUERY:
@@ -15,6 +15,8 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import re
+
 class DNNotIn(Exception):
     def __init__(self, a, b):
         self.a = a
@@ -23,19 +25,64 @@ class DNNotIn(Exception):
     def __str__(self):
         return str(self.a) + " not in " + str(self.b)
 
-class domainname:
+# Lowercased label tuples are interned here, along with their
+# hashes, so that equal names mostly share one tuple and compare by
+# identity. The table is simply emptied when it grows too large.
+labeltable = {}
+labeltablemax = 100000
+
+def internlabel(label):
+    if type(label) == str:
+        return intern(label.lower())
+    # Such as unicode labels, which intern() does not take
+    return label.lower()
+
+def internlabels(parts):
+    # Most names are lowercase already, and so found as they are
+    ret = labeltable.get(parts)
+    if ret is not None:
+        return ret
+    labels = tuple([internlabel(p) for p in parts])
+    ret = labeltable.get(labels)
+    if ret is None:
+        if len(labeltable) >= labeltablemax:
+            labeltable.clear()
+        ret = labeltable[labels] = (labels, hash(labels))
+    return ret
+
+class domainname(object):
     "A class for abstract representations of domain names"
+    __slots__ = ["parts", "rooted", "labels", "hashval", "wire"]
     
-    def __init__(self, parts, rooted):
-        self.parts = parts
-        self.rooted = rooted
+    def __init__(self, parts = (), rooted = False):
+        parts = tuple(parts)
+        labels, hashval = internlabels(parts)
+        setattr_ = object.__setattr__
+        setattr_(self, "parts", parts)
+        setattr_(self, "rooted", rooted)
+        setattr_(self, "labels", labels)
+        setattr_(self, "hashval", hashval ^ -int(rooted))
+        setattr_(self, "wire", None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("domain names are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("domain names are immutable")
+
+    def __getstate__(self):
+        # Kept the same as the __dict__ of old, classic domainname
+        # instances, which are still found in zone databases.
+        return {"parts": list(self.parts), "rooted": self.rooted}
+
+    def __setstate__(self, state):
+        domainname.__init__(self, state["parts"], state["rooted"])
     
     def __repr__(self):
-        ret = ""
-        if len(self.parts) > 0:
-            for p in self.parts[:-1]:
-                ret = ret + p + '.'
-            ret = ret + self.parts[-1]
+        ret = ".".join(self.parts)
+        if "\\" in ret or ret.count(".") > max(len(self.parts) - 1, 0):
+            # Some label contains a dot or backslash
+            ret = ".".join([p.replace("\\", "\\\\").replace(".", "\\.") for p in self.parts])
         if self.rooted:
             ret = ret + '.'
         return ret
@@ -59,12 +106,7 @@ class domainname:
             y = fromstring(y)
         if self.rooted != y.rooted:
             return False
-        if len(self.parts) != len(y.parts):
-            return False
-        for i in range(len(self.parts)):
-            if self.parts[i].lower() != y.parts[i].lower():
-                return False
-        return True
+        return self.labels is y.labels or (self.hashval == y.hashval and self.labels == y.labels)
 
     def __ne__(self, y):
         return not self.__eq__(y)
@@ -72,9 +114,9 @@ class domainname:
     def __contains__(self, y):
         if len(self) > len(y):
             return False
-        if len(self) == 0:
-            return self.rooted == y.rooted
-        return y[-len(self):] == self
+        if self.rooted != y.rooted:
+            return False
+        return y.labels[len(y) - len(self):] == self.labels
 
     def __sub__(self, y):
         if self not in y:
@@ -82,20 +124,17 @@ class domainname:
         return self[:len(self) - len(y)]
 
     def __hash__(self):
-        ret = 0
-        for part in self.parts:
-            ret = ret ^ hash(part)
-        if self.rooted:
-            ret = ret ^ -1
-        return ret
+        return self.hashval
 
     def canonwire(self):
-        ret = ""
-        for p in self.parts:
-            ret += chr(len(p))
-            ret += p.lower()
-        ret += chr(0)
-        return ret
+        if self.wire is None:
+            ret = ""
+            for p in self.labels:
+                ret += chr(len(p))
+                ret += p
+            ret += chr(0)
+            object.__setattr__(self, "wire", ret)
+        return self.wire
     
 class DNError(Exception):
     emptypart = 1
@@ -106,26 +145,265 @@ class DNError(Exception):
         return {1: "empty part",
                 2: "illegal character"}[self.kind]
 
-def fromstring(name):
+# Characters not allowed unescaped in names given as strings
+illegalchars = re.compile(r"[\x00- ]")
+
+def parseescaped(name):
+    # Handles backslash escapes as in master files: \X stands for X,
+    # and \DDD for the octet with the decimal value DDD.
     parts = []
+    cur = []
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if c == "\\":
+            if name[i + 1:i + 4].isdigit() and len(name[i + 1:i + 4]) == 3:
+                cur.append(chr(int(name[i + 1:i + 4]) & 0xff))
+                i += 4
+            elif i + 1 < len(name):
+                cur.append(name[i + 1])
+                i += 2
+            else:
+                raise DNError(DNError.illegalchar)
+            continue
+        if c == ".":
+            parts.append("".join(cur))
+            cur = []
+        else:
+            cur.append(c)
+        i += 1
+    parts.append("".join(cur))
+    return parts
+
+def parse(name):
     if name == ".":
         return domainname([], True)
     if name == "":
         return domainname([], False)
-    while name.find('.') >= 0:
-        cur = name.find('.')
-        if cur == 0:
-            raise DNError(DNError.emptypart)
-        part = name[:cur]
-        for c in part:
-            if ord(c) < 33:
-                raise DNError(DNError.illegalchar)
-        parts.append(part)
-        name = name[cur + 1:]
-    if len(name) > 0:
-        parts.append(name)
-        rooted = False
+    if illegalchars.search(name):
+        raise DNError(DNError.illegalchar)
+    if "\\" in name:
+        parts = parseescaped(name)
     else:
-        rooted = True
+        parts = name.split(".")
+    rooted = parts[-1] == ""
+    if rooted:
+        del parts[-1]
+    if "" in parts:
+        raise DNError(DNError.emptypart)
     return domainname(parts, rooted)
 
+# Recently parsed names are kept in two generations, the current one
+# being moved to the older one when it fills up. This approximates an
+# LRU without needing any locking, as each operation on the dicts is
+# atomic.
+parsedmax = 10000
+parsed = {}
+parsedold = {}
+
+def fromstring(name):
+    global parsed, parsedold
+    ret = parsed.get(name)
+    if ret is not None:
+        return ret
+    ret = parsedold.get(name)
+    if ret is None:
+        ret = parse(name)
+    if len(parsed) >= parsedmax:
+        parsedold = parsed
+        parsed = {}
+    parsed[name] = ret
+    return ret
+
+class treenode(object):
+    # The labels of the edge leading to a node are kept in reverse
+    # order, from the root towards the node. A node holds an entry
+    # when name is not None. The entry of a node is never changed once
+    # it is linked into a tree; a new node is swapped in instead.
+    __slots__ = ["edge", "name", "value", "children"]
+
+    def __init__(self, edge, name = None, value = None, children = None):
+        self.edge = edge
+        self.name = name
+        self.value = value
+        self.children = children
+
+class nametree(object):
+    "A label-reversed radix tree mapping domain names to values"
+    # Keys ignore rootedness. Lookups may run beside a single writer,
+    # which only links in fully built nodes.
+
+    def __init__(self):
+        self.root = treenode(())
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def key(self, name):
+        if type(name) == str:
+            name = fromstring(name)
+        return name, name.labels[::-1]
+
+    def relink(self, parent, node, new):
+        if parent is None:
+            self.root = new
+        else:
+            parent.children[node.edge[0]] = new
+
+    def add(self, name, value):
+        name, k = self.key(name)
+        parent = None
+        node = self.root
+        i = 0
+        while i < len(k):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(k[i])
+            if child is None:
+                node.children[k[i]] = treenode(k[i:], name, value)
+                self.count += 1
+                return
+            e = child.edge
+            m = 1
+            while m < len(e) and i + m < len(k) and e[m] == k[i + m]:
+                m += 1
+            if m < len(e):
+                # Split the edge, building the new part before linking
+                # it in place of the old child.
+                mid = treenode(e[:m], children = {e[m]: treenode(e[m:], child.name, child.value, child.children)})
+                if i + m == len(k):
+                    mid.name, mid.value = name, value
+                else:
+                    mid.children[k[i + m]] = treenode(k[i + m:], name, value)
+                node.children[k[i]] = mid
+                self.count += 1
+                return
+            parent, node = node, child
+            i += m
+        if node.name is None:
+            self.count += 1
+        self.relink(parent, node, treenode(node.edge, name, value, node.children))
+    __setitem__ = add
+
+    def find(self, k):
+        node = self.root
+        i = 0
+        while i < len(k):
+            children = node.children
+            if children is None:
+                return None
+            node = children.get(k[i])
+            if node is None:
+                return None
+            e = node.edge
+            if len(e) > 1 and k[i:i + len(e)] != e:
+                return None
+            i += len(e)
+        return node
+
+    def get(self, name, default = None):
+        node = self.find(self.key(name)[1])
+        if node is None or node.name is None:
+            return default
+        return node.value
+
+    def __getitem__(self, name):
+        node = self.find(self.key(name)[1])
+        if node is None or node.name is None:
+            raise KeyError(name)
+        return node.value
+
+    def __contains__(self, name):
+        node = self.find(self.key(name)[1])
+        return node is not None and node.name is not None
+
+    def longest(self, name):
+        "Returns the (name, value) pair of the closest enclosing name"
+        if type(name) == str:
+            name = fromstring(name)
+        k = name.labels[::-1]
+        node = self.root
+        ret = None
+        if node.name is not None:
+            ret = node
+        i = 0
+        while i < len(k):
+            children = node.children
+            if children is None:
+                break
+            node = children.get(k[i])
+            if node is None:
+                break
+            e = node.edge
+            if len(e) > 1 and k[i:i + len(e)] != e:
+                break
+            i += len(e)
+            if node.name is not None:
+                ret = node
+        if ret is None:
+            return None
+        return ret.name, ret.value
+
+    def remove(self, name):
+        k = self.key(name)[1]
+        path = [self.root]
+        node = self.root
+        i = 0
+        while i < len(k):
+            if node.children is None:
+                raise KeyError(name)
+            node = node.children.get(k[i])
+            if node is None or k[i:i + len(node.edge)] != node.edge:
+                raise KeyError(name)
+            i += len(node.edge)
+            path.append(node)
+        if node.name is None:
+            raise KeyError(name)
+        new = treenode(node.edge, children = node.children)
+        self.relink((len(path) > 1 and path[-2]) or None, node, new)
+        node = path[-1] = new
+        self.count -= 1
+        # Prune the node if it is empty, and merge what is left over
+        # with its single child, if any.
+        if len(path) > 1 and not node.children:
+            path.pop()
+            parent = path[-1]
+            del parent.children[node.edge[0]]
+            if not parent.children:
+                parent.children = None
+            node = parent
+        if len(path) > 1 and node.name is None and node.children and len(node.children) == 1:
+            (child,) = node.children.values()
+            path[-2].children[node.edge[0]] = treenode(node.edge + child.edge, child.name, child.value, child.children)
+    __delitem__ = remove
+
+    def subtree(self, name = None):
+        "Iterates over (name, value) pairs under name, in canonical order"
+        node = self.root
+        if name is not None:
+            k = self.key(name)[1]
+            i = 0
+            while i < len(k):
+                children = node.children
+                if children is None:
+                    return
+                node = children.get(k[i])
+                if node is None:
+                    return
+                e = node.edge
+                # The subtree may begin in the middle of an edge
+                if k[i:i + len(e)] != e[:len(k) - i]:
+                    return
+                i += len(e)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.name is not None:
+                yield node.name, node.value
+            children = node.children
+            if children:
+                stack.extend([child for l, child in sorted(children.items(), reverse = True)])
+
+    def __iter__(self):
+        return self.subtree()
@@ -46,6 +46,8 @@ class valuecache:
 class prefix6to4(server.handler):
     def __init__(self, next, v4addr):
         self.next = next
+        self.cacheable = next.cacheable
+        self.generation = next.generation
         if callable(v4addr):
             self.packed = v4addr
         elif len(v4addr) == 4:
@@ -69,6 +71,8 @@ class prefix6to4(server.handler):
         return resp
 
 class addrfilter(server.handler):
+    cacheable = False
+
     def __init__(self, default = None, matchers = []):
         self.matchers = matchers
         self.default = default
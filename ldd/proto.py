@@ -44,6 +44,11 @@ class packet:
         self.addr = addr
         self.signed = False
         self.tsigctx = None
+        self.qtime = None
+        self.deadline = None
+        self.cachekey = None
+        self.cachever = None
+        self.rrindex = None
         if type(flags) == int:
             self.initflags(flags)
         elif type(flags) == set:
@@ -51,6 +56,28 @@ class packet:
         else:
             self.flags = set(flags)
         
+    def __getattr__(self, name):
+        # Sections of lazily decoded packets are decoded on first use
+        raw = self.__dict__.get("rawsections")
+        if raw is None or name not in raw:
+            raise AttributeError(name)
+        start, count = raw[name]
+        lst = []
+        offset = start
+        try:
+            for i in xrange(count):
+                crr, offset = rec.rr.decode(self.rawpacket, offset, self.rawnames, True)
+                lst.append(crr)
+        except rec.malformedrr, inst:
+            raise malformedpacket(str(inst), self.qid)
+        except (IndexError, struct.error):
+            raise malformedpacket("truncated packet", self.qid)
+        # Only forget the raw section once it has decoded, so that
+        # later accesses fail the same way
+        del raw[name]
+        self.__dict__[name] = lst
+        return lst
+
     def setflags(self, flags):
         flags = set(flags)
         self.flags |= flags
@@ -87,57 +114,94 @@ class packet:
     def addq(self, rr):
         self.qlist.append(rr)
 
-    def addan(self, rr):
-        for rr2 in self.anlist:
-            if rr2.head  == rr.head and rr2.data == rr.data:
-                break
+    def getindex(self):
+        # The index is rebuilt whenever a section list has been
+        # replaced or changed length behind the packet's back. Its
+        # parts are built only once needed, as hashing RRs costs more
+        # than scanning a few of them.
+        lists = (self.anlist, self.aulist, self.adlist)
+        idx = self.rrindex
+        if idx is not None:
+            ilists, ilens = idx[0], idx[1]
+            if ilists[0] is lists[0] and ilists[1] is lists[1] and ilists[2] is lists[2] and \
+                    ilens[0] == len(lists[0]) and ilens[1] == len(lists[1]) and ilens[2] == len(lists[2]):
+                return idx
+        idx = self.rrindex = [lists, [len(lst) for lst in lists], [None, None, None], None]
+        return idx
+
+    def addrr(self, sect, rr):
+        idx = self.getindex()
+        lst = idx[0][sect]
+        keys = idx[2][sect]
+        if keys is None and len(lst) >= 8:
+            keys = idx[2][sect] = set([(rr2.head, rr2.data) for rr2 in lst])
+        if keys is None:
+            for rr2 in lst:
+                if rr2.head == rr.head and rr2.data == rr.data:
+                    return
         else:
-            self.anlist.append(rr)
+            key = (rr.head, rr.data)
+            if key in keys:
+                return
+            keys.add(key)
+        lst.append(rr)
+        idx[1][sect] += 1
+        answers = idx[3]
+        if answers is not None:
+            cur = answers.get(rr.head)
+            if cur is None or cur[0] > sect:
+                answers[rr.head] = (sect, rr)
+
+    def addan(self, rr):
+        self.addrr(0, rr)
 
     def addau(self, rr):
-        for rr2 in self.aulist:
-            if rr2.head  == rr.head and rr2.data == rr.data:
-                break
-        else:
-            self.aulist.append(rr)
+        self.addrr(1, rr)
 
     def addad(self, rr):
-        for rr2 in self.adlist:
-            if rr2.head  == rr.head and rr2.data == rr.data:
-                break
-        else:
-            self.adlist.append(rr)
+        self.addrr(2, rr)
 
     def allrrs(self):
         return self.anlist + self.aulist + self.adlist
 
     def merge(self, other):
-        for lst in ["anlist", "aulist", "adlist"]:
+        for sect, lst in enumerate(["anlist", "aulist", "adlist"]):
             for rr in getattr(other, lst):
-                for rr2 in getattr(self, lst):
-                    if rr2.head == rr.head and rr2.data == rr.data:
-                        break
-                else:
-                    getattr(self, lst).append(rr)
+                self.addrr(sect, rr)
     
     def getanswer(self, name, rtype):
-        for rr in self.anlist + self.aulist + self.adlist:
-            if rr.head.istype(rtype) and rr.head.name == name:
-                return rr
-        return None
+        if type(rtype) == str:
+            rtype = rec.rtypebyname(rtype)
+        idx = self.getindex()
+        answers = idx[3]
+        if answers is None:
+            lists = idx[0]
+            if len(lists[0]) + len(lists[1]) + len(lists[2]) < 8:
+                for lst in lists:
+                    for rr in lst:
+                        if rr.head.rtype == rtype and rr.head.name == name:
+                            return rr
+                return None
+            answers = idx[3] = {}
+            for i in xrange(3):
+                for rr in lists[i]:
+                    if rr.head not in answers:
+                        answers[rr.head] = (i, rr)
+        ret = answers.get(rec.rrhead(name, rtype))
+        if ret is None:
+            return None
+        return ret[1]
 
     def hasanswers(self):
+        cname = rec.rtypebyname("CNAME")
         for q in self.qlist:
-            for rr in self.anlist + self.aulist + self.adlist:
-                if rr.head.rtype == q.rtype and rr.head.name == q.name:
-                    break
-                if rr.head.istype("CNAME") and rr.head.name == q.name and self.getanswer(rr.data["priname"], q.rtype) is not None:
-                    break
-            else:
-                break
-        else:
-            return True
-        return False
+            if self.getanswer(q.name, q.rtype) is not None:
+                continue
+            rr = self.getanswer(q.name, cname)
+            if rr is not None and self.getanswer(rr.data["priname"], q.rtype) is not None:
+                continue
+            return False
+        return True
         
     def __str__(self):
         ret = ""
@@ -160,47 +224,60 @@ class packet:
         return ret
 
     def encode(self):
-        ret = ""
-        ret += struct.pack(">6H", self.qid, self.encodeflags(), len(self.qlist), len(self.anlist), len(self.aulist), len(self.adlist))
-        offset = len(ret)
-        names = []
+        buf = bytearray(struct.pack(">6H", self.qid, self.encodeflags(), len(self.qlist), len(self.anlist), len(self.aulist), len(self.adlist)))
+        names = {}
         for rr in self.qlist:
-            rre, names = rr.encode(names, offset)
-            offset += len(rre)
-            ret += rre
+            rr.encode(buf, names)
         for rr in self.anlist:
-            rre, names = rr.encode(names, offset)
-            offset += len(rre)
-            ret += rre
+            rr.encode(buf, names)
         for rr in self.aulist:
-            rre, names = rr.encode(names, offset)
-            offset += len(rre)
-            ret += rre
+            rr.encode(buf, names)
         for rr in self.adlist:
-            rre, names = rr.encode(names, offset)
-            offset += len(rre)
-            ret += rre
-        return ret
+            rr.encode(buf, names)
+        return str(buf)
 
-def decodepacket(string):
-    offset = struct.calcsize(">6H")
-    qid, flags, qno, anno, auno, adno = struct.unpack(">6H", string[0:offset])
+def decodepacket(string, lazy = False):
+    "Decodes a packet from its wire format"
+    # With lazy, sections other than the question, and RR data, decode
+    # on first access; errors surface then and duplicates go unchecked.
+    if len(string) < 12:
+        raise malformedpacket("packet shorter than header", None)
+    qid, flags, qno, anno, auno, adno = struct.unpack_from(">6H", string, 0)
+    offset = 12
     ret = packet(qid, flags)
+    # Names decoded so far, by offset, for resolving compression
+    names = {}
     try:
-        for i in range(qno):
-            crr, offset = rec.rrhead.decode(string, offset)
+        for i in xrange(qno):
+            crr, offset = rec.rrhead.decode(string, offset, names)
             ret.addq(crr)
-        for i in range(anno):
-            crr, offset = rec.rr.decode(string, offset)
+        if lazy:
+            ret.rawpacket = string
+            ret.rawnames = names
+            ret.rawsections = {}
+            for lst, count in (("anlist", anno), ("aulist", auno), ("adlist", adno)):
+                ret.rawsections[lst] = (offset, count)
+                delattr(ret, lst)
+                for i in xrange(count):
+                    offset = skipname(string, offset) + 10
+                    (dlen,) = struct.unpack_from(">H", string, offset - 2)
+                    offset += dlen
+            if offset > len(string):
+                raise malformedpacket("truncated packet", qid)
+            return ret
+        for i in xrange(anno):
+            crr, offset = rec.rr.decode(string, offset, names)
             ret.addan(crr)
-        for i in range(auno):
-            crr, offset = rec.rr.decode(string, offset)
+        for i in xrange(auno):
+            crr, offset = rec.rr.decode(string, offset, names)
             ret.addau(crr)
-        for i in range(adno):
-            crr, offset = rec.rr.decode(string, offset)
+        for i in xrange(adno):
+            crr, offset = rec.rr.decode(string, offset, names)
             ret.addad(crr)
     except rec.malformedrr, inst:
         raise malformedpacket(str(inst), qid)
+    except (IndexError, struct.error):
+        raise malformedpacket("truncated packet", qid)
     return ret
 
 def responsefor(pkt, rescode = 0):
@@ -211,39 +288,127 @@ def responsefor(pkt, rescode = 0):
     resp.qlist = pkt.qlist + []  # Make a copy
     return resp
 
-def decodename(packet, offset):
+def decodename(packet, offset, names = None):
+    "Decodes the name at offset, returning it and the offset after it"
+    # names caches the names already decoded from the packet, by the
+    # offsets where they start and where compression pointers lead.
+    if names is not None:
+        # Most names are either decoded already or a single pointer to
+        # one that is, which need none of the bookkeeping below.
+        cached = names.get(offset)
+        if cached is not None:
+            end = cached[2]
+        else:
+            clen = ord(packet[offset])
+            if clen >= 0xc0:
+                ptr = ((clen & 0x3f) << 8) | ord(packet[offset + 1])
+                if ptr < offset:
+                    cached = names.get(ptr)
+                    end = offset + 2
+        if cached is not None:
+            ret = cached[3]
+            if ret is None:
+                ret = cached[3] = dn.domainname(cached[0][cached[1]:], True)
+            return ret, end
     parts = []
+    # The runs of labels making up the name, as (start, index of
+    # first label, offset following the run), for caching
+    runs = []
+    start = offset
+    idx = 0
+    end = None
+    limit = offset
+    wlen = 1
     while True:
         clen = ord(packet[offset])
+        if clen == 0:
+            offset += 1
+            runs.append((start, idx, offset))
+            break
+        if clen >= 0xc0:
+            ptr = ((clen & 0x3f) << 8) | ord(packet[offset + 1])
+            offset += 2
+            runs.append((start, idx, offset))
+            if end is None:
+                end = offset
+            # Only allow jumping backwards, which rules out loops
+            if ptr >= limit:
+                raise rec.malformedrr("bad compression pointer")
+            limit = start = offset = ptr
+            idx = len(parts)
+            if names is not None:
+                cached = names.get(ptr)
+                if cached is not None:
+                    parts.extend(cached[0][cached[1]:])
+                    break
+            continue
+        if clen & 0xc0:
+            raise rec.malformedrr("unknown label type")
         offset += 1
+        parts.append(packet[offset:offset + clen])
+        offset += clen
+        wlen += 1 + clen
+        if wlen > 255:
+            raise rec.malformedrr("domain name too long")
+    if end is None:
+        end = offset
+    ret = dn.domainname(parts, True)
+    if names is not None:
+        # The label list is never modified once the name is built, so
+        # the cache can refer into it.
+        for start, idx, runend in runs:
+            if idx == 0:
+                names[start] = [parts, idx, runend, ret]
+            else:
+                names[start] = [parts, idx, runend, None]
+    return ret, end
+
+def skipname(packet, offset):
+    while True:
+        clen = ord(packet[offset])
         if clen & 0xc0:
-            my = dn.domainname(parts, False)
-            cont, = struct.unpack(">H", chr(clen & 0x3f) + packet[offset])
-            res, discard = decodename(packet, cont)
-            return my + res, offset + 1
-        elif clen == 0:
-            return dn.domainname(parts, True), offset
-        else:
-            parts.append(packet[offset:offset + clen])
-            offset += clen
+            return offset + 2
+        offset += 1
+        if clen == 0:
+            return offset
+        offset += clen
+
+def ttloffsets(packet):
+    "Returns the offset and value of every TTL field in an encoded packet"
+    qno, anno, auno, adno = struct.unpack(">4H", packet[4:12])
+    offset = 12
+    for i in xrange(qno):
+        offset = skipname(packet, offset) + 4
+    ret = []
+    for i in xrange(anno + auno + adno):
+        offset = skipname(packet, offset) + 4
+        ttl, dlen = struct.unpack(">LH", packet[offset:offset + 6])
+        ret.append((offset, ttl))
+        offset += 6 + dlen
+    return ret
 
 def encodename(dn, names, offset):
-    ret = ""
-    for i in range(len(dn)):
-        for name, off in names:
-            if name == dn[i:]:
-                ret += chr(0xc0 + (off >> 8))
-                ret += chr(off & 0xff)
-                offset += 2
-                return ret, names
+    "Encodes a domain name at offset, using and updating the suffix offsets in names"
+    parts = dn.parts
+    key = dn.labels
+    ret = []
+    for i in xrange(len(parts)):
+        off = names.get(key[i:])
+        if off is not None:
+            ret.append(chr(0xc0 | (off >> 8)) + chr(off & 0xff))
+            return "".join(ret), names
         if offset < 16384:
-            names += [(dn[i:], offset)]
-        ret += chr(len(dn.parts[i]))
-        ret += dn.parts[i]
-        offset += 1 + len(dn.parts[i])
-    ret += chr(0)
-    offset += 1
-    return ret, names
+            names[key[i:]] = offset
+        p = parts[i]
+        ret.append(chr(len(p)) + p)
+        offset += 1 + len(p)
+    ret.append("\0")
+    return "".join(ret), names
+
+def encodenameto(buf, dn, names):
+    "Appends a domain name to buf, which starts at the start of the packet"
+    ret, names = encodename(dn, names, len(buf))
+    buf += ret
 
 # Opcode constants
 QUERY = 0
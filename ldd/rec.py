@@ -22,21 +22,136 @@ import proto
 import dn
 
 rtypes = []
+rtypesbyid = {}
+rtypesbyname = {}
+codecs = {}
+fieldmaps = {}
+
+def fixedcodec(fields, first):
+    # A run of fixed-size fields is packed with a single struct
+    fmt = ">"
+    wide = False
+    for e in fields:
+        if e[2] == "strc":
+            fmt += "%is" % e[3]
+        elif e[2] == "short":
+            fmt += "H"
+        elif e[2] == "long":
+            fmt += "L"
+        elif e[2] == "int6":
+            fmt += "HL"
+            wide = True
+    st = struct.Struct(fmt)
+    size = st.size
+    last = first + len(fields)
+    if not wide:
+        def encode(buf, names, values):
+            buf += st.pack(*values[first:last])
+        def decode(packet, offset, names, values):
+            values.extend(st.unpack_from(packet, offset))
+            return offset + size
+        return encode, decode
+    kinds = [e[2] for e in fields]
+    def encode(buf, names, values):
+        vals = []
+        for k, v in zip(kinds, values[first:last]):
+            if k == "int6":
+                vals += [v >> 32, v & 0xffffffff]
+            else:
+                vals.append(v)
+        buf += st.pack(*vals)
+    def decode(packet, offset, names, values):
+        vals = st.unpack_from(packet, offset)
+        i = 0
+        for k in kinds:
+            if k == "int6":
+                values.append((vals[i] << 32) | vals[i + 1])
+                i += 2
+            else:
+                values.append(vals[i])
+                i += 1
+        return offset + size
+    return encode, decode
+
+def fieldcodec(e, i):
+    if e[2] == "cmdn":
+        def encode(buf, names, values):
+            proto.encodenameto(buf, values[i], names)
+        def decode(packet, offset, names, values):
+            d, offset = proto.decodename(packet, offset, names)
+            values.append(d)
+            return offset
+    elif e[2] == "lstr":
+        def encode(buf, names, values):
+            d = values[i]
+            buf += chr(len(d)) + d
+        def decode(packet, offset, names, values):
+            dl = ord(packet[offset])
+            values.append(packet[offset + 1:offset + 1 + dl])
+            return offset + 1 + dl
+    elif e[2] == "llstr":
+        def encode(buf, names, values):
+            d = values[i]
+            buf += struct.pack(">H", len(d)) + d
+        def decode(packet, offset, names, values):
+            (dl,) = struct.unpack_from(">H", packet, offset)
+            values.append(packet[offset + 2:offset + 2 + dl])
+            return offset + 2 + dl
+    else:
+        raise error("unknown field encoding " + e[2])
+    return encode, decode
+
+def compilecodec(syntax):
+    "Compiles the syntax of an RR type into its encode and decode functions"
+    # decode appends to the values list and returns the offset after the data.
+    parts = []
+    run = []
+    for i, e in enumerate(syntax):
+        if e[2] in ("strc", "short", "long", "int6"):
+            run.append(e)
+            continue
+        if run:
+            parts.append(fixedcodec(run, i - len(run)))
+            run = []
+        parts.append(fieldcodec(e, i))
+    if run:
+        parts.append(fixedcodec(run, len(syntax) - len(run)))
+    if len(parts) == 1:
+        return parts[0]
+    encs = [p[0] for p in parts]
+    decs = [p[1] for p in parts]
+    def encode(buf, names, values):
+        for enc in encs:
+            enc(buf, names, values)
+    def decode(packet, offset, names, values):
+        for dec in decs:
+            offset = dec(packet, offset, names, values)
+        return offset
+    return encode, decode
+
+def fieldmap(syntax):
+    ret = {}
+    for i, e in enumerate(syntax):
+        ret[e[1]] = i
+    return ret
 
 def addrtype(id, name, syntax):
-    rtypes.append((id, name, syntax))
+    rtype = (id, name, syntax)
+    rtypes.append(rtype)
+    # The first registration of an ID or name takes precedence
+    rtypesbyid.setdefault(id, rtype)
+    rtypesbyname.setdefault(name, id)
+    codecs.setdefault(id, compilecodec(syntax))
+    fieldmaps.setdefault(id, fieldmap(syntax))
 
 def rtypebyid(id):
-    for rtype in rtypes:
-        if rtype[0] == id:
-            return rtype
-    return None
+    return rtypesbyid.get(id)
 
 def rtypebyname(name):
-    for rtype in rtypes:
-        if rtype[1] == name.upper():
-            return rtype[0]
-    return None
+    return rtypesbyname.get(name.upper())
+
+# Shared by all RRs without flags
+noflags = frozenset()
 
 class error(Exception):
     def __init__(self, text):
@@ -52,7 +167,9 @@ class malformedrr(Exception):
     def __str__(self):
         return self.text
 
-class rrhead:
+class rrhead(object):
+    __slots__ = ["name", "rtype", "rclass"]
+
     def __init__(self, name = None, rtype = None, rclass = None):
         if rclass is None: rclass = CLASSIN
         if type(name) == str:
@@ -67,14 +184,16 @@ class rrhead:
             self.rtype = rtype
         self.rclass = rclass
 
-    def encode(self, names, offset):
-        ret, names = proto.encodename(self.name, names, offset)
-        ret += struct.pack(">HH", self.rtype, self.rclass)
-        return ret, names
+    def encode(self, buf, names):
+        proto.encodenameto(buf, self.name, names)
+        buf += struct.pack(">HH", self.rtype, self.rclass)
 
     def __eq__(self, other):
         return self.name == other.name and self.rtype == other.rtype
 
+    def __hash__(self):
+        return hash((self.name, self.rtype))
+
     def __str__(self):
         rtype = rtypebyid(self.rtype)
         if rtype is None:
@@ -87,19 +206,34 @@ class rrhead:
             rtype = rtypebyname(rtype)
         return self.rtype == rtype
         
-    def decode(self, packet, offset):
-        name, offset = proto.decodename(packet, offset)
-        rtype, rclass = struct.unpack(">HH", packet[offset:offset + struct.calcsize(">HH")])
-        offset += struct.calcsize(">HH")
+    def decode(self, packet, offset, names = None):
+        name, offset = proto.decodename(packet, offset, names)
+        rtype, rclass = struct.unpack_from(">HH", packet, offset)
         ret = rrhead(name, rtype, rclass)
-        return ret, offset
+        return ret, offset + 4
     decode = classmethod(decode)
 
-class rrdata:
-    def __init__(self, rtype, *args):
-        if type(rtype) == tuple and type(args[0]) == dict:
+class rrdata(object):
+    "The data of an RR, as a tuple of field values in syntax order"
+    __slots__ = ["rtype", "values", "fields"]
+
+    def __init__(self, rtype = None, *args):
+        if rtype is None:
+            # Old pickles of rrdata instances are loaded this way
+            return
+        if type(rtype) == tuple:
+            reg = rtypebyid(rtype[0])
+            if reg is not rtype and reg == rtype:
+                # Such as the equal copies that unpickling makes
+                rtype = reg
             self.rtype = rtype
-            self.rdata = args[0]
+            self.fields = fieldmaps.get(rtype[0])
+            if self.fields is None or reg is not rtype:
+                self.fields = fieldmap(rtype[2])
+            if type(args[0]) == tuple:
+                self.values = args[0]
+            else:
+                self.values = tuple([args[0][e[1]] for e in rtype[2]])
             return
         
         if type(rtype) == str:
@@ -112,13 +246,26 @@ class rrdata:
         self.rtype = rtypebyid(rtid)
         if self.rtype is None:
             raise error("no such rtype " + rtid)
-        self.rdata = {}
-        for i, e in enumerate(self.rtype[2]):
-            d = self.convdata(e[0], args[i])
-            self.rdata[e[1]] = d
+        self.fields = fieldmaps[rtid]
+        self.values = tuple([self.convdata(e[0], args[i]) for i, e in enumerate(self.rtype[2])])
 
     def __eq__(self, other):
-        return(self.rdata == other.rdata)
+        return self.values == other.values and self.rtype[0] == other.rtype[0]
+
+    def __hash__(self):
+        return hash(self.values)
+
+    def getrdata(self):
+        return dict(zip([e[1] for e in self.rtype[2]], self.values))
+    rdata = property(getrdata)
+
+    def __getstate__(self):
+        # Kept the same as the __dict__ of old, classic rrdata
+        # instances, which are still found in zone databases.
+        return {"rtype": self.rtype, "rdata": self.rdata}
+
+    def __setstate__(self, state):
+        rrdata.__init__(self, state["rtype"], state["rdata"])
 
     def __str__(self):
         ret = "{"
@@ -128,7 +275,7 @@ class rrdata:
                 ret += ", "
             first = False
             ret += e[1] + ": "
-            d = self.rdata[e[1]]
+            d = self[e[1]]
             if e[0] == "4":
                 ret += socket.inet_ntop(socket.AF_INET, d)
             elif e[0] == "6":
@@ -174,85 +321,41 @@ class rrdata:
         return d
     
     def __iter__(self):
-        return iter(self.rdata)
+        return iter([e[1] for e in self.rtype[2]])
     
     def __getitem__(self, i):
-        return self.rdata[i]
+        return self.values[self.fields[i]]
 
     def __setitem__(self, i, v):
-        for e in self.rtype[2]:
-            if e[1] == i:
-                break
-        else:
+        if i not in self.fields:
             raise error("No such data for " + self.rtype[1] + " record: " + str(i))
-        self.rdata[i] = self.convdata(e[0], v)
+        n = self.fields[i]
+        values = list(self.values)
+        values[n] = self.convdata(self.rtype[2][n][0], v)
+        self.values = tuple(values)
 
-    def encode(self, names, offset):
-        ret = ""
-        for e in self.rtype[2]:
-            d = self.rdata[e[1]]
-            if e[2] == "strc":
-                ret += d
-                offset += len(d)
-            if e[2] == "cmdn":
-                buf, names = proto.encodename(d, names, offset)
-                ret += buf
-                offset += len(buf)
-            if e[2] == "lstr":
-                ret += chr(len(d)) + d
-                offset += 1 + len(d)
-            if e[2] == "llstr":
-                ret += struct.pack(">H", len(d)) + d
-                offset += struct.calcsize(">H") + len(d)
-            if e[2] == "short":
-                ret += struct.pack(">H", d)
-                offset += struct.calcsize(">H")
-            if e[2] == "long":
-                ret += struct.pack(">L", d)
-                offset += struct.calcsize(">L")
-            if e[2] == "int6":
-                ret += struct.pack(">Q", d)[-6:]
-                offset += 6
-        return ret, names
-
-    def decode(self, rtid, packet, offset, dlen):
+    def encode(self, buf, names):
+        codec = codecs.get(self.rtype[0])
+        if codec is None or rtypebyid(self.rtype[0]) is not self.rtype:
+            codec = compilecodec(self.rtype[2])
+        codec[0](buf, names, self.values)
+
+    def decode(self, rtid, packet, offset, dlen, names = None):
+        if offset + dlen > len(packet):
+            raise malformedrr("RR data extends past end of packet")
         rtype = rtypebyid(rtid)
-        origoff = offset
-        rdata = {}
         if rtype is None:
             rtype = (rtid, "Unknown", [("s", "unknown", "strc", dlen)])
-        for e in rtype[2]:
-            if e[2] == "strc":
-                d = packet[offset:offset + e[3]]
-                offset += e[3]
-            if e[2] == "cmdn":
-                d, offset = proto.decodename(packet, offset)
-            if e[2] == "lstr":
-                dl = ord(packet[offset])
-                offset += 1
-                d = packet[offset:offset + dl]
-                offset += dl
-            if e[2] == "llstr":
-                (dl,) = struct.unpack(">H", packet[offset:offset + struct.calcsize(">H")])
-                offset += struct.calcsize(">H")
-                d = packet[offset:offset + dl]
-                offset += dl
-            if e[2] == "short":
-                (d,) = struct.unpack(">H", packet[offset:offset + struct.calcsize(">H")])
-                offset += struct.calcsize(">H")
-            if e[2] == "long":
-                (d,) = struct.unpack(">L", packet[offset:offset + struct.calcsize(">L")])
-                offset += struct.calcsize(">L")
-            if e[2] == "int6":
-                (d,) = struct.unpack(">Q", ("\0" * (struct.calcsize(">Q") - 6)) + packet[offset:offset + 6])
-                offset += 6
-            rdata[e[1]] = d
-        if origoff + dlen != offset:
+            return rrdata(rtype, (packet[offset:offset + dlen],))
+        values = []
+        if codecs[rtid][1](packet, offset, names, values) != offset + dlen:
             raise malformedrr(rtype[1] + " RR data length mismatch")
-        return rrdata(rtype, rdata)
+        return rrdata(rtype, tuple(values))
     decode = classmethod(decode)
 
-class rr:
+class rr(object):
+    __slots__ = ["head", "ttl", "data", "flags", "rawdata"]
+
     def __init__(self, head, ttl, data):
         if type(head) == tuple:
             self.head = rrhead(*head)
@@ -260,27 +363,28 @@ class rr:
             self.head = head
         self.ttl = ttl
         self.data = data
-        self.flags = set()
+        self.flags = noflags
 
     def setflags(self, flags):
-        self.flags |= set(flags)
+        self.flags = self.flags | frozenset(flags)
 
     def clrflags(self, flags):
-        self.flags -= set(flags)
+        self.flags = self.flags - frozenset(flags)
     
-    def encode(self, names, offset):
-        ret, names = self.head.encode(names, offset)
-        if self.data is None:
-            data = ""
-        else:
-            data, names = self.data.encode(names, offset + len(ret) + struct.calcsize(">LH"))
-        ret += struct.pack(">LH", self.ttl, len(data))
-        ret += data
-        return ret, names
+    def encode(self, buf, names):
+        self.head.encode(buf, names)
+        start = len(buf)
+        buf += "\0" * 6
+        if self.data is not None:
+            self.data.encode(buf, names)
+        struct.pack_into(">LH", buf, start, self.ttl, len(buf) - start - 6)
 
     def __eq__(self, other):
         return self.head == other.head and self.ttl == other.ttl and self.data == other.data
 
+    def __hash__(self):
+        return hash((self.head, self.ttl, self.data))
+
     def __str__(self):
         rtype = rtypebyid(self.head.rtype)
         if rtype is None:
@@ -295,14 +399,37 @@ class rr:
             ret += ")"
         return ret
     
-    def decode(self, packet, offset):
-        head, offset = rrhead.decode(packet, offset)
-        ttl, dlen = struct.unpack(">LH", packet[offset:offset + struct.calcsize(">LH")])
-        offset += struct.calcsize(">LH")
+    def __getattr__(self, name):
+        # The data of lazily decoded RRs is decoded on first use
+        if name != "data":
+            raise AttributeError(name)
+        try:
+            raw = self.rawdata
+        except AttributeError:
+            raise AttributeError(name)
+        try:
+            data = rrdata.decode(*raw)
+        except (IndexError, struct.error):
+            raise malformedrr("truncated RR data")
+        del self.rawdata
+        self.data = data
+        return data
+
+    def decode(self, packet, offset, names = None, lazy = False):
+        head, offset = rrhead.decode(packet, offset, names)
+        ttl, dlen = struct.unpack_from(">LH", packet, offset)
+        offset += 6
         if dlen == 0:
             data = None
+        elif lazy:
+            if offset + dlen > len(packet):
+                raise malformedrr("RR data extends past end of packet")
+            ret = rr(head, ttl, None)
+            del ret.data
+            ret.rawdata = (head.rtype, packet, offset, dlen, names)
+            return ret, offset + dlen
         else:
-            data = rrdata.decode(head.rtype, packet, offset, dlen)
+            data = rrdata.decode(head.rtype, packet, offset, dlen, names)
             offset += dlen
         return rr(head, ttl, data), offset
     decode = classmethod(decode)
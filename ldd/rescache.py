@@ -17,84 +17,348 @@
 
 import threading
 import time
+import heapq
+import collections
+import logging
 
 import resolver
 import proto
 import rec
 
+logger = logging.getLogger("ldd.rescache")
+
 class nxdmark:
     def __init__(self, expire, auth):
         self.expire = expire
         self.auth = auth
 
+class pendinglookup(object):
+    # An upstream lookup in progress, which other threads missing the
+    # same name and type wait for instead of querying again.
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+class refresher(threading.Thread):
+    def __init__(self, cache):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.cache = cache
+
+    def run(self):
+        while True:
+            name, rtype = self.cache.nextrefresh()
+            try:
+                self.cache.refresh(name, rtype)
+            except:
+                logger.exception("could not refresh %s", name)
+
+def entrysize(ent):
+    # A rough estimate of the memory held by a cache entry
+    if isinstance(ent, nxdmark):
+        return 200 + 150 * len(ent.auth)
+    return 100 + 150 * len(ent)
+
+def entryexpiry(ent):
+    if isinstance(ent, nxdmark):
+        return ent.expire
+    return min([cl[0] for cl in ent])
+
+class cacheshard(object):
+    # One shard of a cacheresolver's cache, with the state needed to
+    # bound and expire it. All methods must be called with lock held.
+    def __init__(self, maxentries, maxbytes):
+        self.cache = dict()
+        self.lock = threading.Lock()
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.size = 0
+        # The CLOCK ring of cached names, and the set of names used
+        # since the clock hand last passed them. The ring may also
+        # hold names no longer cached.
+        self.ring = collections.deque()
+        self.used = set()
+        # A heap of (time, name) at which to check names for expired
+        # records. Names may be listed more than once, or no longer be
+        # cached at all, by the time they come up.
+        self.expiry = []
+        # Lookups in progress, by (name, rtype)
+        self.inflight = {}
+        # The number of hits on each name since it was last stored
+        self.hitcounts = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def setentry(self, name, ent):
+        old = self.cache.pop(name, None)
+        if old is not None:
+            self.size -= entrysize(old)
+        if isinstance(ent, nxdmark) or len(ent) > 0:
+            self.cache[name] = ent
+            self.size += entrysize(ent)
+            if old is None:
+                self.ring.append(name)
+            heapq.heappush(self.expiry, (entryexpiry(ent), name))
+            self.hitcounts.pop(name, None)
+            if len(self.expiry) > 2 * len(self.cache) + 1000:
+                self.expiry = [(entryexpiry(ent), name) for name, ent in self.cache.iteritems()]
+                heapq.heapify(self.expiry)
+            if len(self.ring) > 2 * len(self.cache) + 1000:
+                self.ring = collections.deque(self.cache.iterkeys())
+        else:
+            self.used.discard(name)
+            self.hitcounts.pop(name, None)
+        while len(self.cache) > self.maxentries or self.size > self.maxbytes:
+            name = self.ring.popleft()
+            if name not in self.cache:
+                continue
+            if name in self.used:
+                self.used.discard(name)
+                self.ring.append(name)
+                continue
+            self.size -= entrysize(self.cache.pop(name))
+            self.hitcounts.pop(name, None)
+            self.evictions += 1
+
+    def purge(self, now):
+        while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+            exp, name = heapq.heappop(self.expiry)
+            ent = self.cache.get(name)
+            if ent is None:
+                continue
+            if isinstance(ent, nxdmark):
+                if ent.expire <= now:
+                    del self.cache[name]
+                    self.used.discard(name)
+                    self.hitcounts.pop(name, None)
+                    self.size -= entrysize(ent)
+                    self.expirations += 1
+                else:
+                    heapq.heappush(self.expiry, (ent.expire, name))
+                continue
+            keep = [cl for cl in ent if cl[0] > now]
+            if len(keep) == len(ent):
+                heapq.heappush(self.expiry, (entryexpiry(ent), name))
+                continue
+            self.expirations += len(ent) - len(keep)
+            self.size -= entrysize(ent)
+            if len(keep) == 0:
+                del self.cache[name]
+                self.used.discard(name)
+                self.hitcounts.pop(name, None)
+            else:
+                self.cache[name] = keep
+                self.size += entrysize(keep)
+                heapq.heappush(self.expiry, (entryexpiry(keep), name))
+
 class cacheresolver(resolver.resolver):
-    def __init__(self, resolver):
+    "A sharded, size-bounded cache in front of another resolver"
+
+    def __init__(self, resolver, maxentries = 100000, maxbytes = 64 << 20, nshards = 16, waittimeout = 5.0,
+                 refreshhits = 8, refreshfrac = 0.1, refreshers = 2):
         self.resolver = resolver
-        self.cache = dict()
-        self.cachelock = threading.Lock()
+        self.waittimeout = waittimeout
+        self.refreshhits = refreshhits
+        self.refreshfrac = refreshfrac
+        self.refreshers = refreshers
+        self.refreshqmax = 1000
+        self.refreshq = collections.deque()
+        self.refreshlock = threading.Condition()
+        # Refreshes queued or in progress, by (name, rtype)
+        self.refreshing = set()
+        self.refreshthreads = []
+        self.refreshes = 0
+        self.refreshdrops = 0
+        self.shards = [cacheshard(max(maxentries // nshards, 1), max(maxbytes // nshards, 1)) for i in xrange(nshards)]
+
+    def shardfor(self, name):
+        return self.shards[hash(name) % len(self.shards)]
+
+    def stats(self):
+        ret = {"entries": 0, "bytes": 0, "hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "coalesced": 0}
+        for shard in self.shards:
+            shard.lock.acquire()
+            try:
+                ret["entries"] += len(shard.cache)
+                ret["bytes"] += shard.size
+                ret["hits"] += shard.hits
+                ret["misses"] += shard.misses
+                ret["evictions"] += shard.evictions
+                ret["expirations"] += shard.expirations
+                ret["coalesced"] += shard.coalesced
+            finally:
+                shard.lock.release()
+        self.refreshlock.acquire()
+        try:
+            ret["refreshes"] = self.refreshes
+            ret["refreshdrops"] = self.refreshdrops
+        finally:
+            self.refreshlock.release()
+        return ret
+
+    def prefetch(self, name, rtype):
+        key = (name, rtype)
+        self.refreshlock.acquire()
+        try:
+            if key in self.refreshing:
+                return
+            if len(self.refreshq) >= self.refreshqmax:
+                self.refreshdrops += 1
+                return
+            self.refreshing.add(key)
+            self.refreshq.append(key)
+            if len(self.refreshthreads) < self.refreshers:
+                th = refresher(self)
+                self.refreshthreads.append(th)
+                th.start()
+            self.refreshlock.notify()
+        finally:
+            self.refreshlock.release()
+
+    def nextrefresh(self):
+        self.refreshlock.acquire()
+        try:
+            while len(self.refreshq) == 0:
+                self.refreshlock.wait()
+            return self.refreshq.popleft()
+        finally:
+            self.refreshlock.release()
+
+    def refresh(self, name, rtype):
+        try:
+            self.dolookup(name, rtype, time.time() + self.waittimeout)
+        finally:
+            self.refreshlock.acquire()
+            try:
+                self.refreshing.discard((name, rtype))
+                self.refreshes += 1
+            finally:
+                self.refreshlock.release()
 
     def getcached(self, name, rtype = proto.QTANY):
-        self.cachelock.acquire()
+        shard = self.shards[hash(name) % len(self.shards)]
+        now = int(time.time())
+        stale = None
+        shard.lock.acquire()
         try:
-            if name not in self.cache:
+            if shard.expiry and shard.expiry[0][0] <= now:
+                shard.purge(now)
+            ent = shard.cache.get(name)
+            if ent is None:
+                shard.misses += 1
                 return []
-            now = int(time.time())
-            if isinstance(self.cache[name], nxdmark):
-                if self.cache[name].expire < now:
-                    self.cache[name] = []
-                    return []
-                return self.cache[name]
-            ret = []
+            shard.used.add(name)
+            if isinstance(ent, nxdmark):
+                shard.hits += 1
+                return ent
             if rtype == proto.QTANY:
-                cond = lambda rt: True
-            elif type(rtype) == int:
-                cond = lambda rt: rtype == rt
-            elif type(rtype) == str:
-                rtid = rec.rtypebyname(rtype)
-                cond = lambda rt: rtid == rt
+                match = [cl for cl in ent if cl[0] > now]
+            else:
+                if type(rtype) == int:
+                    rtset = (rtype,)
+                elif type(rtype) == str:
+                    rtset = (rec.rtypebyname(rtype),)
+                else:
+                    rtset = set([((type(rtid) == str) and rec.rtypebyname(rtid)) or rtid for rtid in rtype])
+                match = [cl for cl in ent if cl[0] > now and cl[1] in rtset]
+            if len(match) > 0:
+                shard.hits += 1
+                if self.refreshhits is not None:
+                    hits = shard.hitcounts[name] = shard.hitcounts.get(name, 0) + 1
+                    if hits > self.refreshhits:
+                        stale = set([cl[1] for cl in match if cl[0] - now <= max(cl[4] * self.refreshfrac, 1)])
+            else:
+                shard.misses += 1
+        finally:
+            shard.lock.release()
+        if stale:
+            for trd in stale:
+                self.prefetch(name, trd)
+        # Cached lists are never modified once stored, so the records
+        # can be built outside the lock.
+        return [(rec.rr((name, trd), exp - now, data), auth) for exp, trd, data, auth, ttl in match]
+
+    def dolookup(self, name, rtype, deadline = None):
+        key = (name, rtype)
+        shard = self.shardfor(name)
+        shard.lock.acquire()
+        try:
+            pend = shard.inflight.get(key)
+            if pend is None:
+                lead = True
+                pend = shard.inflight[key] = pendinglookup()
+            else:
+                lead = False
+                shard.coalesced += 1
+        finally:
+            shard.lock.release()
+        if not lead:
+            if deadline is None:
+                timeout = self.waittimeout
             else:
-                rtset = set([((type(rtid) == str) and rec.rtypebyname(rtid)) or rtid for rtid in rtype])
-                cond = lambda rt: rt in rtset
-            for exp, trd, data, auth in self.cache[name]:
-                if exp > now and cond(trd):
-                    ret += [(rec.rr((name, trd), exp - now, data), auth)]
-            return ret
+                timeout = deadline - time.time()
+            pend.done.wait(max(timeout, 0))
+            return pend.result
+        try:
+            pend.result = self.fetch(name, rtype, deadline)
         finally:
-            self.cachelock.release()
+            shard.lock.acquire()
+            try:
+                del shard.inflight[key]
+            finally:
+                shard.lock.release()
+            pend.done.set()
+        return pend.result
 
-    def dolookup(self, name, rtype):
+    def fetch(self, name, rtype, deadline):
         try:
-            res = self.resolver.squery(name, rtype)
-        except resolver.servfail, resolver.unreachable:
+            res = self.resolver.squery(name, rtype, deadline)
+        except (resolver.servfail, resolver.unreachable):
             return None
         if res is None:
             return None
+        try:
+            # Decode lazily decoded responses fully up front
+            for rr in res.allrrs():
+                rr.data
+        except (proto.malformedpacket, rec.malformedrr):
+            return None
         if res.rescode == proto.NXDOMAIN:
             ttl = 300
             for rr in res.aulist:
                 if rr.head.istype("SOA"):
                     ttl = rr.data["minttl"]
             nc = nxdmark(int(time.time()) + ttl, res.aulist)
-            self.cachelock.acquire()
+            shard = self.shardfor(name)
+            shard.lock.acquire()
             try:
-                self.cache[name] = nc
+                shard.setentry(name, nc)
             finally:
-                self.cachelock.release()
+                shard.lock.release()
             return nc
         now = int(time.time())
-        self.cachelock.acquire()
-        try:
-            alltypes = set([rr.head.rtype for rr in res.allrrs()])
-            for name in set([rr.head.name for rr in res.allrrs()]):
-                if name in self.cache:
-                    self.cache[name] = [cl for cl in self.cache[name] if cl[1] not in alltypes]
-            for rr in res.allrrs():
-                if rr.head.name not in self.cache:
-                    self.cache[rr.head.name] = []
-                self.cache[rr.head.name] += [(now + rr.ttl, rr.head.rtype, rr.data, [rr for rr in res.aulist if rr.head.istype("NS")])]
-            return res
-        finally:
-            self.cachelock.release()
+        alltypes = set([rr.head.rtype for rr in res.allrrs()])
+        nsrecs = [rr for rr in res.aulist if rr.head.istype("NS")]
+        new = {}
+        for rr in res.allrrs():
+            new.setdefault(rr.head.name, []).append((now + rr.ttl, rr.head.rtype, rr.data, nsrecs, rr.ttl))
+        for rrname, added in new.iteritems():
+            shard = self.shardfor(rrname)
+            shard.lock.acquire()
+            try:
+                shard.purge(now)
+                old = shard.cache.get(rrname)
+                if old is None or isinstance(old, nxdmark):
+                    ent = added
+                else:
+                    ent = [cl for cl in old if cl[1] not in alltypes] + added
+                shard.setentry(rrname, ent)
+            finally:
+                shard.lock.release()
+        return res
 
     def addcached(self, packet, cis):
         for item, auth in cis:
@@ -129,7 +393,7 @@ class cacheresolver(resolver.resolver):
                         continue
                 break
             if len(cis) == 0:
-                tres = self.dolookup(name, rtype)
+                tres = self.dolookup(name, rtype, packet.deadline)
                 if isinstance(tres, nxdmark) and len(packet.qlist) == 1:
                     res.rescode = proto.NXDOMAIN
                     res.aulist = tres.auth
@@ -39,14 +39,19 @@ class unreachable(error):
     def __init__(self, server):
         error.__init__(self, "could not reach server: " + str(server))
 
-def resolvecnames(pkt, res = None):
+def deadlinepassed(deadline):
+    return deadline is not None and time.time() >= deadline
+
+def resolvecnames(pkt, res = None, deadline = None):
     if res is None: res = default
     for q in pkt.qlist:
         cnrr = pkt.getanswer(q.name, rec.rtypebyname("CNAME"))
         if cnrr is not None:
             if pkt.getanswer(cnrr.data["priname"], q.rtype) is None:
+                if deadlinepassed(deadline):
+                    return
                 try:
-                    resp = res.squery(cnrr.data["priname"], q.rtype)
+                    resp = res.squery(cnrr.data["priname"], q.rtype, deadline)
                 except error:
                     continue
                 if resp is None:
@@ -56,15 +61,17 @@ def resolvecnames(pkt, res = None):
                     continue
                 pkt.addan(anrr)
 
-def resolveadditional(pkt, rr, res = None):
+def resolveadditional(pkt, rr, res = None, deadline = None):
     if res is None: res = default
     for name in rr.data:
         if isinstance(rr.data[name], dn.domainname):
             for rtype in ["A", "AAAA"]:
                 if pkt.getanswer(rr.data[name], rtype) is not None:
                     continue
+                if deadlinepassed(deadline):
+                    return
                 try:
-                    resp = res.squery(rr.data[name], rtype)
+                    resp = res.squery(rr.data[name], rtype, deadline)
                 except error:
                     continue
                 if resp is None:
@@ -91,10 +98,17 @@ def resolve(packet, nameserver, recurse, retries = 3, timeout = 2000, hops = 0,
     sk = socket.socket(nameserver[0], socket.SOCK_DGRAM)
     sk.bind(("", 0))
     for i in range(retries):
+        ctimeout = timeout
+        if packet.deadline is not None:
+            left = int((packet.deadline - time.time()) * 1000)
+            if left <= 0:
+                sk.close()
+                raise error("deadline passed")
+            ctimeout = min(timeout, left)
         sk.sendto(packet.encode(), nameserver[1:])
         p = select.poll()
         p.register(sk.fileno(), select.POLLIN)
-        fds = p.poll(timeout)
+        fds = p.poll(ctimeout)
         if (sk.fileno(), select.POLLIN) in fds:
             break
     else:
@@ -102,7 +116,7 @@ def resolve(packet, nameserver, recurse, retries = 3, timeout = 2000, hops = 0,
     ret = sk.recv(65536)
     sk.close()
     try:
-        resp = proto.decodepacket(ret)
+        resp = proto.decodepacket(ret, True)
     except proto.malformedpacket, inst:
         raise error(str(inst))
     if resp.qid != packet.qid:
@@ -116,7 +130,7 @@ def resolve(packet, nameserver, recurse, retries = 3, timeout = 2000, hops = 0,
             return resp
         raise error("non-successful response (" + str(resp.rescode) + ")")
     if recurse:
-        resolvecnames(resp, cnameres)
+        resolvecnames(resp, cnameres, packet.deadline)
     if not recurse or resp.hasanswers():
         return resp
     if not resp.hasanswers() and "auth" in resp.flags:
@@ -133,7 +147,7 @@ def resolve(packet, nameserver, recurse, retries = 3, timeout = 2000, hops = 0,
             if len(ai) == 0:
                 if verbose:
                     print (hops * " ") + "Resolving nameservers for " + str(rr.data["nsname"])
-                resolveadditional(resp, rr)
+                resolveadditional(resp, rr, deadline = packet.deadline)
                 ai = extractaddrinfo(resp, rr.data["nsname"])
             for ns in ai:
                 ns += (53,)
@@ -174,13 +188,23 @@ class resolver:
         self.verbose = verbose
 
     def resolve(self, packet):
-        return resolve(packet, self.nameserver, self.recurse, self.retries, self.timeout, verbose = self.verbose)
+        try:
+            resp = resolve(packet, self.nameserver, self.recurse, self.retries, self.timeout, verbose = self.verbose)
+            if resp is not None:
+                # Decode the rest of the response before it escapes
+                for rr in resp.allrrs():
+                    rr.data
+            return resp
+        except (proto.malformedpacket, rec.malformedrr), inst:
+            # From a lazily decoded section of some response
+            raise error(str(inst))
 
-    def squery(self, name, rtype):
+    def squery(self, name, rtype, deadline = None):
         packet = proto.packet()
         try:
             if self.nsrecurse: packet.setflags(["recurse"])
         except AttributeError: pass
+        packet.deadline = deadline
         packet.addq(rec.rrhead(name, rtype))
         return self.resolve(packet)
 
@@ -258,14 +282,13 @@ class sysresolver(resolver):
         self.prelist = []
         for prefix in prelist:
             pp = dn.fromstring(prefix)
-            pp.rooted = True
-            self.prelist += [pp]
+            self.prelist += [dn.domainname(pp.parts, True)]
 
     def resolve(self, packet):
         res = self.resolver.resolve(packet)
         return res
 
-    def squery(self, name, rtype):
+    def squery(self, name, rtype, deadline = None):
         if type(name) == str:
             name = dn.fromstring(name)
         if not name.rooted:
@@ -275,6 +298,7 @@ class sysresolver(resolver):
         for name in namelist:
             packet = proto.packet()
             packet.setflags(["recurse"])
+            packet.deadline = deadline
             packet.addq(rec.rrhead(name, rtype))
             res = self.resolve(packet)
             if res.rescode == 0:
@@ -15,12 +15,19 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import os
+import sys
+import types
+import heapq
+import fcntl
 import socket
 import threading
 import select
 import errno
 import logging
 import time
+import struct
+import collections
 
 import proto
 import rec
@@ -29,12 +36,245 @@ import resolver
 
 logger = logging.getLogger("ldd.server")
 
+# Python 2 does not export this, so use the Linux value
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+class expired(Exception):
+    def __init__(self, pkt):
+        self.pkt = pkt
+
+    def __str__(self):
+        return "request %04x is past its deadline" % self.pkt.qid
+
+class result:
+    "Yielded by a coroutine handler to finish with a value"
+
+    def __init__(self, value):
+        self.value = value
+
+class readable:
+    "Yielded by a coroutine handler to wait for a socket to become readable"
+
+    def __init__(self, sk, timeout):
+        self.sk = sk
+        self.timeout = timeout
+
+    def wait(self, loop, task):
+        fd = self.sk.fileno()
+        def ready():
+            loop.canceltimer(timer)
+            task.step(True)
+        def expire():
+            loop.unwatch(fd)
+            task.step(False)
+        timer = loop.calllater(self.timeout, expire)
+        loop.watch(fd, ready)
+
+class task:
+    "Runs a generator-based coroutine on the listener's event loop"
+    # The coroutine may yield a wait object, a generator to run to
+    # completion, or its result; done gets the outcome.
+
+    def __init__(self, loop, gen, done):
+        self.loop = loop
+        self.stack = [gen]
+        self.done = done
+
+    def step(self, val = None):
+        exc = None
+        while True:
+            gen = self.stack[-1]
+            try:
+                if exc is not None:
+                    ret = gen.throw(*exc)
+                    exc = None
+                else:
+                    ret = gen.send(val)
+            except StopIteration:
+                ret = result(None)
+            except:
+                self.stack.pop()
+                if len(self.stack) == 0:
+                    self.done(None, sys.exc_info())
+                    return
+                exc = sys.exc_info()
+                continue
+            if isinstance(ret, result):
+                gen.close()
+                self.stack.pop()
+                if len(self.stack) == 0:
+                    self.done(ret.value, None)
+                    return
+                val = ret.value
+            elif isinstance(ret, types.GeneratorType):
+                self.stack.append(ret)
+                val = None
+            else:
+                ret.wait(self.loop, self)
+                return
+
+class answercache:
+    "A cache of encoded responses, keyed on the raw question"
+    # Only plain single-question queries are cached, so that hits can be
+    # answered from the request datagram without decoding it.
+
+    def __init__(self, maxentries = 10000, maxbytes = 4 << 20, maxttl = 300):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.maxttl = maxttl
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # Bumped by flushzone, so that responses computed before a
+        # flush are not stored after it
+        self.versions = {}
+        # The last seen generations of zones whose data can change
+        # behind the server's back, as other processes write it
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def reqkey(self, req):
+        if len(req) < 17:
+            return None
+        flags, qno, anno, auno, adno = struct.unpack(">5H", req[2:12])
+        # Must be a query with only a question section
+        if flags & 0xf800 != 0 or qno != 1 or anno != 0 or auno != 0 or adno != 0:
+            return None
+        offset = 12
+        while True:
+            clen = ord(req[offset])
+            if clen == 0:
+                break
+            if clen & 0xc0:
+                return None
+            offset += 1 + clen
+            if offset >= len(req):
+                return None
+        if offset + 5 != len(req):
+            return None
+        return (flags & 0x0100, req[12:offset + 1].lower(), req[offset + 1:])
+
+    def lookup(self, req):
+        "Returns the cached response for req, if any, and req's key"
+        key = self.reqkey(req)
+        if key is None:
+            return None, None
+        now = time.time()
+        self.lock.acquire()
+        try:
+            ent = self.entries.pop(key, None)
+            if ent is None:
+                self.misses += 1
+                return None, key
+            data, ttls, stored, expire, zone = ent
+            if expire <= now:
+                self.size -= len(data)
+                self.misses += 1
+                return None, key
+            self.entries[key] = ent
+            self.hits += 1
+        finally:
+            self.lock.release()
+        ret = bytearray(data)
+        ret[0:2] = req[0:2]
+        # Echo the question exactly as asked
+        ret[12:len(req)] = req[12:]
+        age = int(now - stored)
+        if age > 0:
+            for offset, ttl in ttls:
+                struct.pack_into(">L", ret, offset, max(ttl - age, 0))
+        return str(ret), key
+
+    def zoneversion(self, zone):
+        return self.versions.get(zone, 0)
+
+    def store(self, key, resp, zone, version):
+        ttl = self.maxttl
+        for rr in resp.allrrs():
+            ttl = min(ttl, rr.ttl)
+        for rr in resp.aulist:
+            if rr.head.istype("SOA"):
+                ttl = min(ttl, rr.data["minttl"])
+        if len(resp.allrrs()) == 0 or ttl <= 0:
+            return None
+        data = resp.encode()
+        if len(data) > 512 or len(data) > self.maxbytes:
+            return None
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if self.versions.get(zone, 0) != version:
+                return None
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self.entries[key] = (data, proto.ttloffsets(data), now, now + ttl, zone)
+            self.size += len(data)
+            while len(self.entries) > self.maxentries or self.size > self.maxbytes:
+                key, ent = self.entries.popitem(False)
+                self.size -= len(ent[0])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+        return data
+
+    def flushzone(self, zone):
+        self.lock.acquire()
+        try:
+            self.versions[zone] = self.versions.get(zone, 0) + 1
+            for key, ent in self.entries.items():
+                if ent[4] is zone:
+                    del self.entries[key]
+                    self.size -= len(ent[0])
+        finally:
+            self.lock.release()
+
+    def checkzones(self, zones):
+        for zone in zones:
+            if zone.handler.generation is None:
+                continue
+            try:
+                gen = zone.handler.generation()
+            except:
+                logger.exception("could not check %s for changes", zone.origin)
+                continue
+            if self.generations.get(zone) != gen:
+                self.flushzone(zone)
+                self.generations[zone] = gen
+
+    def stats(self):
+        return {"entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
 class dnsserver:
     class socklistener(threading.Thread):
         def __init__(self, server):
             threading.Thread.__init__(self)
             self.server = server
             self.alive = True
+            self.poller = select.epoll()
+            self.fdmap = {}
+            self.tcpmap = {}
+            self.conns = {}
+            self.watches = {}
+            self.timers = []
+            self.tseq = 0
+            self.pending = collections.deque()
+            self.received = 0
+            self.malformed = 0
+            self.wakefds = os.pipe()
+            for fd in self.wakefds:
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self.poller.register(self.wakefds[0], select.EPOLLIN)
+            for af, sk in server.sockets:
+                self.addsock(af, sk)
+            for af, sk in server.tcpsockets:
+                self.addtcpsock(af, sk)
 
         class sender:
             def __init__(self, addr, sk):
@@ -43,57 +283,575 @@ class dnsserver:
 
             def send(self, pkt):
                 logger.debug("sending response to %04x", pkt.qid)
-                self.sk.sendto(pkt.encode(), self.addr)
+                data = pkt.encode()
+                if len(data) > 512:
+                    # Let the client retry over TCP
+                    tc = proto.responsefor(pkt, pkt.rescode)
+                    tc.flags = pkt.flags | set(["trunc"])
+                    data = tc.encode()
+                self.senddata(data)
+
+            def senddata(self, data):
+                try:
+                    self.sk.sendto(data, self.addr)
+                except socket.error, e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    logger.warning("send buffer full, dropping response to %s", self.addr[0])
+
+            def drop(self):
+                pass
+
+        class tcpconn:
+            "A DNS-over-TCP client connection, and the sender of its responses"
+
+            def __init__(self, listener, af, sk, addr):
+                self.listener = listener
+                self.af = af
+                self.sk = sk
+                self.addr = addr
+                self.inbuf = ""
+                self.outbuf = ""
+                self.pending = 0
+                self.eof = False
+                self.stalled = False
+                self.closed = False
+                self.lock = threading.Lock()
+                self.lastactive = time.time()
+
+            def send(self, pkt):
+                logger.debug("sending response to %04x over TCP", pkt.qid)
+                data = pkt.encode()
+                self.lock.acquire()
+                try:
+                    if self.closed:
+                        return
+                    self.pending -= 1
+                    self.outbuf += struct.pack(">H", len(data)) + data
+                    self.flush()
+                finally:
+                    self.lock.release()
+
+            def drop(self):
+                # For requests that are dropped without an answer
+                self.lock.acquire()
+                try:
+                    if self.closed:
+                        return
+                    self.pending -= 1
+                    self.flush()
+                finally:
+                    self.lock.release()
+
+            def flush(self):
+                # Called with the lock held
+                if self.closed:
+                    return
+                try:
+                    while len(self.outbuf) > 0:
+                        n = self.sk.send(self.outbuf)
+                        self.outbuf = self.outbuf[n:]
+                        self.lastactive = time.time()
+                except socket.error, e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                        self.listener.callsoon(self.close)
+                        return
+                events = 0
+                if not self.eof and not self.backlogged():
+                    events |= select.EPOLLIN
+                if len(self.outbuf) > 0:
+                    events |= select.EPOLLOUT
+                if self.stalled and not self.backlogged():
+                    self.stalled = False
+                    self.listener.callsoon(self.readable)
+                if events == 0 and self.eof and self.pending <= 0 and not self.stalled:
+                    self.listener.callsoon(self.close)
+                    return
+                self.listener.poller.modify(self.sk.fileno(), events)
+
+            def backlogged(self):
+                # Stop reading from clients that do not read their answers
+                server = self.listener.server
+                return self.pending >= server.tcppending or len(self.outbuf) >= server.tcpoutbuf
+
+            def readable(self):
+                if self.closed:
+                    return
+                batch = []
+                limit = self.listener.server.tcppending
+                while True:
+                    while len(self.inbuf) >= 2 and self.pending + len(batch) < limit:
+                        (dl,) = struct.unpack(">H", self.inbuf[:2])
+                        if len(self.inbuf) < 2 + dl:
+                            break
+                        req = self.inbuf[2:2 + dl]
+                        self.inbuf = self.inbuf[2 + dl:]
+                        self.listener.received += 1
+                        try:
+                            pkt = proto.decodepacket(req, True)
+                        except proto.malformedpacket, inst:
+                            self.listener.malformed += 1
+                            if inst.qid is None:
+                                continue
+                            pkt = proto.packet(inst.qid, ["resp"])
+                            pkt.rescode = proto.FORMERR
+                            self.pending += 1
+                            self.send(pkt)
+                        else:
+                            logger.debug("got TCP request (%04x) from %s", pkt.qid, self.addr[0])
+                            pkt.addr = (self.af,) + self.addr
+                            batch.append((pkt, self))
+                    if self.pending + len(batch) >= limit:
+                        # Resumed by flush once answers have gone out
+                        self.stalled = True
+                        break
+                    if self.eof:
+                        break
+                    try:
+                        data = self.sk.recv(65536)
+                    except socket.error, e:
+                        if e.errno == errno.EINTR:
+                            continue
+                        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            break
+                        self.close()
+                        return
+                    if data == "":
+                        self.eof = True
+                        continue
+                    self.lastactive = time.time()
+                    self.inbuf += data
+                self.lock.acquire()
+                try:
+                    self.pending += len(batch)
+                    self.flush()
+                finally:
+                    self.lock.release()
+                if len(batch) > 0:
+                    self.listener.server.queuereqs(batch)
+
+            def writable(self):
+                self.lock.acquire()
+                try:
+                    self.flush()
+                finally:
+                    self.lock.release()
+
+            def close(self):
+                self.lock.acquire()
+                try:
+                    if self.closed:
+                        return
+                    self.closed = True
+                finally:
+                    self.lock.release()
+                fd = self.sk.fileno()
+                if fd in self.listener.conns:
+                    del self.listener.conns[fd]
+                    self.listener.poller.unregister(fd)
+                self.sk.close()
+
+        def addsock(self, af, sk):
+            fd = sk.fileno()
+            if fd in self.fdmap:
+                return
+            sk.setblocking(0)
+            self.fdmap[fd] = (af, sk)
+            self.poller.register(fd, select.EPOLLIN)
+
+        def rmsock(self, sk):
+            fd = sk.fileno()
+            if fd in self.fdmap:
+                del self.fdmap[fd]
+            elif fd in self.tcpmap:
+                del self.tcpmap[fd]
+            else:
+                return
+            self.poller.unregister(fd)
+
+        def addtcpsock(self, af, sk):
+            fd = sk.fileno()
+            if fd in self.tcpmap:
+                return
+            sk.setblocking(0)
+            self.tcpmap[fd] = (af, sk)
+            self.poller.register(fd, select.EPOLLIN)
+
+        def accept(self, af, sk):
+            while True:
+                try:
+                    nsk, addr = sk.accept()
+                except socket.error, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        return
+                    raise
+                if self.server.tcpmax <= 0:
+                    nsk.close()
+                    continue
+                if len(self.conns) >= self.server.tcpmax:
+                    # Make room by dropping the longest idle connection
+                    oldest = min(self.conns.values(), key = lambda conn: conn.lastactive)
+                    logger.debug("too many TCP connections, closing one from %s", oldest.addr[0])
+                    oldest.close()
+                nsk.setblocking(0)
+                conn = dnsserver.socklistener.tcpconn(self, af, nsk, addr)
+                self.conns[nsk.fileno()] = conn
+                self.poller.register(nsk.fileno(), select.EPOLLIN)
+
+        def sweeptcp(self):
+            now = time.time()
+            for conn in self.conns.values():
+                if now - conn.lastactive > self.server.tcpidle:
+                    logger.debug("closing idle TCP connection from %s", conn.addr[0])
+                    conn.close()
+            self.calllater(1.0, self.sweeptcp)
+
+        def watch(self, fd, cb):
+            # One-shot; the watch is removed before cb is called.
+            self.watches[fd] = cb
+            self.poller.register(fd, select.EPOLLIN)
+
+        def unwatch(self, fd):
+            if fd in self.watches:
+                del self.watches[fd]
+                self.poller.unregister(fd)
+
+        def calllater(self, delay, cb):
+            self.tseq += 1
+            timer = [time.time() + delay, self.tseq, cb]
+            heapq.heappush(self.timers, timer)
+            return timer
+
+        def canceltimer(self, timer):
+            timer[2] = None
+
+        def callsoon(self, cb):
+            # May be called from any thread
+            self.pending.append(cb)
+            try:
+                os.write(self.wakefds[1], "x")
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        def spawn(self, gen, done):
+            t = task(self, gen, done)
+            if threading.currentThread() is self:
+                t.step()
+            else:
+                self.callsoon(t.step)
+
+        def runtimers(self):
+            now = time.time()
+            while len(self.timers) > 0 and self.timers[0][0] <= now:
+                when, seq, cb = heapq.heappop(self.timers)
+                if cb is not None:
+                    cb()
+            while len(self.timers) > 0 and self.timers[0][2] is None:
+                heapq.heappop(self.timers)
+            if len(self.timers) > 0:
+                return min(max(self.timers[0][0] - now, 0.0), 1.0)
+            return 1.0
 
         def run(self):
-            while self.alive:
-                p = select.poll()
-                for af, sk in self.server.sockets:
-                    p.register(sk.fileno(), select.POLLIN)
+            self.calllater(1.0, self.sweeptcp)
+            try:
+                timeout = 1.0
+                while self.alive:
+                    try:
+                        fds = self.poller.poll(timeout)
+                    except IOError, e:
+                        if e.errno == errno.EINTR:
+                            continue
+                        raise
+                    for fd, event in fds:
+                        if fd == self.wakefds[0]:
+                            try:
+                                while os.read(fd, 4096) != "":
+                                    pass
+                            except OSError, e:
+                                if e.errno != errno.EAGAIN:
+                                    raise
+                            continue
+                        cb = self.watches.get(fd)
+                        if cb is not None:
+                            self.unwatch(fd)
+                            cb()
+                            continue
+                        conn = self.conns.get(fd)
+                        if conn is not None:
+                            if event & (select.EPOLLHUP | select.EPOLLERR) and conn.eof:
+                                # Nothing more can be read, nor sent
+                                conn.close()
+                                continue
+                            if event & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                                conn.readable()
+                            if event & select.EPOLLOUT and not conn.closed:
+                                conn.writable()
+                            continue
+                        ent = self.tcpmap.get(fd)
+                        if ent is not None:
+                            self.accept(*ent)
+                            continue
+                        if event & select.EPOLLIN == 0:
+                            continue
+                        ent = self.fdmap.get(fd)
+                        if ent is None:
+                            continue
+                        af, sk = ent
+                        batch = self.drain(af, sk)
+                        if len(batch) > 0:
+                            self.server.queuereqs(batch)
+                    while len(self.pending) > 0:
+                        self.pending.popleft()()
+                    timeout = self.runtimers()
+            finally:
+                for conn in self.conns.values():
+                    conn.close()
+                self.poller.close()
+                for fd in self.wakefds:
+                    os.close(fd)
+
+        def drain(self, af, sk):
+            # Read until the socket would block, but no more than one
+            # batch, so that one busy socket cannot starve the others.
+            batch = []
+            while len(batch) < self.server.batchsize:
                 try:
-                    fds = p.poll(1000)
-                except select.error, e:
-                    if e[0] == errno.EINTR:
+                    req, addr = sk.recvfrom(65536)
+                except socket.error, e:
+                    if e.errno == errno.EINTR:
                         continue
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
                     raise
-                for fd, event in fds:
-                    if event & select.POLLIN == 0:
+                self.received += 1
+                key = None
+                if self.server.anscache is not None:
+                    data, key = self.server.anscache.lookup(req)
+                    if data is not None:
+                        dnsserver.socklistener.sender(addr, sk).senddata(data)
                         continue
-                    for af, sk in self.server.sockets:
-                        if sk.fileno() == fd:
-                            break
-                    else:
+                try:
+                    pkt = proto.decodepacket(req, True)
+                except proto.malformedpacket, inst:
+                    self.malformed += 1
+                    if inst.qid is None:
                         continue
-                    req, addr = sk.recvfrom(65536)
-                    try:
-                        pkt = proto.decodepacket(req)
-                    except proto.malformedpacket, inst:
-                        resp = proto.packet(inst.qid, ["resp"])
-                        resp.rescode = proto.FORMERR
-                        sk.sendto(resp.encode(), addr)
-                    else:
-                        logger.debug("got request (%04x) from %s", pkt.qid, addr[0])
-                        pkt.addr = (af,) + addr
-                        self.server.queuereq(pkt, dnsserver.socklistener.sender(addr, sk))
+                    resp = proto.packet(inst.qid, ["resp"])
+                    resp.rescode = proto.FORMERR
+                    dnsserver.socklistener.sender(addr, sk).send(resp)
+                else:
+                    logger.debug("got request (%04x) from %s", pkt.qid, addr[0])
+                    pkt.addr = (af,) + addr
+                    pkt.cachekey = key
+                    batch.append((pkt, dnsserver.socklistener.sender(addr, sk)))
+            return batch
+
+        def kerneldrops(self):
+            # Datagrams discarded by the kernel because a socket's
+            # receive queue was full, as accounted in /proc/net/udp*.
+            inodes = set()
+            for fd in self.fdmap.keys():
+                try:
+                    inodes.add(os.fstat(fd).st_ino)
+                except OSError:
+                    pass
+            ret = 0
+            for fn in ["/proc/net/udp", "/proc/net/udp6"]:
+                try:
+                    f = open(fn, "r")
+                except IOError:
+                    continue
+                try:
+                    f.readline()
+                    for line in f:
+                        words = line.split()
+                        if int(words[9]) in inodes:
+                            ret += int(words[-1])
+                finally:
+                    f.close()
+            return ret
+
+        def stats(self):
+            return {"received": self.received,
+                    "malformed": self.malformed,
+                    "tcpconns": len(self.conns),
+                    "drops": self.kerneldrops()}
 
         def stop(self):
             self.alive = False
 
     class dispatcher(threading.Thread):
-        def __init__(self, server):
+        def __init__(self, server, lane):
             threading.Thread.__init__(self)
             self.server = server
+            self.lane = lane
             self.alive = True
+            self.busy = False
+            self.lastactive = time.time()
 
         def run(self):
             while self.alive:
-                req = self.server.dequeuereq()
+                req = self.lane.dequeuereq()
                 if req is not None:
-                    pkt, sender = req
-                    resp = self.server.handle(pkt)
-                    if resp is None:
-                        resp = proto.responsefor(pkt, proto.SERVFAIL)
-                    sender.send(resp)
+                    self.busy = True
+                    try:
+                        self.process(*req)
+                    except:
+                        logger.exception("dispatcher error")
+                    finally:
+                        self.busy = False
+                        self.lastactive = time.time()
+
+        def process(self, pkt, sender):
+            try:
+                resp = self.server.handle(pkt)
+            except expired:
+                self.server.expire(pkt, sender)
+                return
+            except (proto.malformedpacket, rec.malformedrr), inst:
+                # Found while decoding the rest of the request lazily
+                logger.debug("malformed request %04x: %s", pkt.qid, inst)
+                resp = proto.responsefor(pkt, proto.FORMERR)
+            except:
+                logger.exception("error while handling %04x", pkt.qid)
+                resp = None
+            self.server.respond(pkt, sender, resp)
+
+    class lane:
+        "A request queue together with the dispatchers serving it"
+
+        def __init__(self, server, name):
+            self.server = server
+            self.name = name
+            self.queue = collections.deque()
+            self.queuelock = threading.Condition()
+            self.dispatchers = []
+            self.queuemax = 1000
+            self.overflow = "dropold"
+            self.overflowcount = {"dropold": 0, "dropnew": 0, "servfail": 0, "refused": 0}
+            self.mindispatchers = 10
+            self.maxdispatchers = 100
+            self.idletimeout = 60
+            self.growlatency = 1.0
+            self.waits = collections.deque([], 1000)
+            self.latency = (0.0, 0.0, 0.0)
+
+        def queuereqs(self, reqs, now):
+            refuse = []
+            dropped = []
+            self.queuelock.acquire()
+            try:
+                for req, sender in reqs:
+                    if self.queuemax is not None and len(self.queue) >= self.queuemax:
+                        self.overflowcount[self.overflow] += 1
+                        if self.overflow == "dropold":
+                            dropped.append(self.queue.popleft()[2])
+                        elif self.overflow == "dropnew":
+                            dropped.append(sender)
+                            continue
+                        else:
+                            refuse.append((req, sender))
+                            continue
+                    self.queue.append((now, req, sender))
+                logger.debug("queue length+ (%s): %i", self.name, len(self.queue))
+                self.queuelock.notify(len(reqs))
+            finally:
+                self.queuelock.release()
+            for sender in dropped:
+                sender.drop()
+            if len(refuse) > 0:
+                if self.overflow == "servfail":
+                    rescode = proto.SERVFAIL
+                else:
+                    rescode = proto.REFUSED
+                for req, sender in refuse:
+                    sender.send(proto.responsefor(req, rescode))
+
+        def dequeuereq(self):
+            self.queuelock.acquire()
+            if len(self.queue) == 0:
+                self.queuelock.wait()
+            if len(self.queue) > 0:
+                ret = self.queue.popleft()
+                self.waits.append(time.time() - ret[0])
+            else:
+                ret = None
+            logger.debug("queue length- (%s): %i", self.name, len(self.queue))
+            self.queuelock.release()
+            if ret is None:
+                return None
+            else:
+                return ret[1:]
+
+        def adddispatchers(self, n):
+            for i in xrange(n):
+                newdsp = dnsserver.dispatcher(self.server, self)
+                self.dispatchers += [newdsp]
+                newdsp.start()
+
+        def adjustpool(self):
+            now = time.time()
+            self.queuelock.acquire()
+            try:
+                if len(self.queue) > 0:
+                    headage = now - self.queue[0][0]
+                else:
+                    headage = 0.0
+                waits = sorted(self.waits)
+                self.waits.clear()
+            finally:
+                self.queuelock.release()
+            if len(waits) > 0:
+                self.latency = tuple([waits[int(len(waits) * p)] for p in (0.5, 0.9, 0.99)])
+            else:
+                self.latency = (0.0, 0.0, 0.0)
+
+            ndsp = len(self.dispatchers)
+            if headage > self.growlatency or self.latency[1] > self.growlatency:
+                # Grow geometrically, so that a stall is caught up with
+                # in a few seconds rather than one thread per second.
+                n = min(max(1, ndsp // 4), self.maxdispatchers - ndsp)
+                if n > 0:
+                    self.adddispatchers(n)
+                    logger.debug("starting %i new dispatchers for %s, there are now %i", n, self.name, len(self.dispatchers))
+            elif headage == 0.0 and ndsp > self.mindispatchers:
+                # Retire at most one idle dispatcher per round.
+                for dsp in self.dispatchers:
+                    if not dsp.busy and now - dsp.lastactive > self.idletimeout:
+                        break
+                else:
+                    return
+                dsp.alive = False
+                self.dispatchers.remove(dsp)
+                self.queuelock.acquire()
+                self.queuelock.notifyAll()
+                self.queuelock.release()
+                logger.debug("retiring idle dispatcher for %s, there are now %i", self.name, len(self.dispatchers))
+
+        def poolstats(self):
+            return {"dispatchers": len(self.dispatchers),
+                    "busy": len([dsp for dsp in self.dispatchers if dsp.busy]),
+                    "min": self.mindispatchers,
+                    "max": self.maxdispatchers,
+                    "queued": len(self.queue),
+                    "latency": self.latency}
+
+        def start(self):
+            self.adddispatchers(self.mindispatchers)
+
+        def stop(self):
+            for dsp in self.dispatchers:
+                dsp.alive = False
+            self.queuelock.acquire()
+            self.queuelock.notifyAll()
+            self.queuelock.release()
+            for dsp in self.dispatchers + []:
+                dsp.join()
+                self.dispatchers.remove(dsp)
 
     class queuemonitor(threading.Thread):
         def __init__(self, server):
@@ -102,30 +860,41 @@ class dnsserver:
 
         def run(self):
             while(self.server.running):
-                self.server.queuelock.acquire()
-                if len(self.server.queue) > 0:
-                    peeked = self.server.queue[0]
-                else:
-                    peeked = None
-                self.server.queuelock.release()
-                if peeked is not None:
-                    if time.time() - peeked[0] > 1:
-                        newdsp = dnsserver.dispatcher(self.server)
-                        self.server.dispatchers += [newdsp]
-                        newdsp.start()
-                        logger.debug("starting new dispatcher, there are now %i", len(self.server.dispatchers))
+                for lane in self.server.lanes.values():
+                    lane.adjustpool()
+                if self.server.anscache is not None:
+                    self.server.anscache.checkzones(self.server.zones)
                 time.sleep(1)
 
     def __init__(self):
         self.sockets = []
-        self.queue = []
+        self.tcpsockets = []
         self.zones = []
+        # Zones by origin, with separate trees for rooted and
+        # relative origins, which only match names of their own kind
+        self.zoneindex = {True: dn.nametree(), False: dn.nametree()}
         self.listener = None
-        self.dispatchers = []
         self.running = False
-        self.queuelock = threading.Condition()
+        self.lanes = {}
+        self.deflane = self.addlane("default")
+        self.batchsize = 32
+        self.tcpmax = 1000
+        self.tcpidle = 10.0
+        self.tcppending = 100
+        self.tcpoutbuf = 1 << 20
+        self.deadline = 5.0
+        self.onexpire = "drop"
+        self.expirecount = 0
+        self.engine = "threads"
+        self.anscache = None
         self.knownkeys = []
 
+    def findzone(self, name):
+        ret = self.zoneindex[name.rooted].longest(name)
+        if ret is None:
+            return None
+        return ret[1]
+
     def handle(self, pkt):
         resp = None
 
@@ -134,17 +903,19 @@ class dnsserver:
             dnssec.tsigverify(pkt, self.knownkeys)
         
         for query in pkt.qlist:
-            match = None
-            for zone in self.zones:
-                if query.name in zone.origin:
-                    if match is None:
-                        match = zone
-                    elif len(zone.origin) > len(match.origin):
-                        match = zone
+            match = self.findzone(query.name)
             if match is None:
                 return None
             else:
+                if pkt.qtime is not None:
+                    pkt.deadline = pkt.qtime + self.deadlinefor(match)
+                    if time.time() > pkt.deadline:
+                        raise expired(pkt)
+                if pkt.cachekey is not None:
+                    pkt.cachever = (match, self.anscache.zoneversion(match))
                 curresp = match.handle(query, pkt)
+                if pkt.opcode == proto.UPDATE and self.anscache is not None:
+                    self.anscache.flushzone(match)
                 if resp is None:
                     resp = curresp
                 else:
@@ -155,34 +926,190 @@ class dnsserver:
 
         return resp
 
+    def handlegen(self, pkt):
+        # Coroutine counterpart of handle, used for packets all of
+        # whose zones can be handled on the event loop.
+        resp = None
+
+        if len(self.knownkeys) > 0:
+            import dnssec
+            dnssec.tsigverify(pkt, self.knownkeys)
+
+        for query in pkt.qlist:
+            match = self.findzone(query.name)
+            if match is None:
+                yield result(None)
+            if pkt.qtime is not None:
+                pkt.deadline = pkt.qtime + self.deadlinefor(match)
+                if time.time() > pkt.deadline:
+                    raise expired(pkt)
+            if pkt.cachekey is not None:
+                pkt.cachever = (match, self.anscache.zoneversion(match))
+            curresp = yield match.handlegen(query, pkt)
+            if pkt.opcode == proto.UPDATE and self.anscache is not None:
+                self.anscache.flushzone(match)
+            if resp is None:
+                resp = curresp
+            else:
+                resp.merge(curresp)
+
+        if resp is not None and resp.tsigctx is not None and not resp.signed:
+            resp.tsigctx.signpkt(resp)
+
+        yield result(resp)
+
+    def iscoro(self, pkt):
+        if len(pkt.qlist) == 0:
+            return False
+        for query in pkt.qlist:
+            zone = self.findzone(query.name)
+            if zone is None or zone.handlegen is None or zone.handler.handlegen is None:
+                return False
+        return True
+
+    def spawnreq(self, pkt, sender):
+        def done(resp, exc):
+            if exc is not None:
+                if isinstance(exc[1], expired):
+                    self.expire(pkt, sender)
+                    return
+                if isinstance(exc[1], (proto.malformedpacket, rec.malformedrr)):
+                    self.respond(pkt, sender, proto.responsefor(pkt, proto.FORMERR))
+                    return
+                logger.error("error while handling %04x", pkt.qid, exc_info = exc)
+                resp = None
+            self.respond(pkt, sender, resp)
+        self.listener.spawn(self.handlegen(pkt), done)
+
+    def respond(self, pkt, sender, resp):
+        if resp is None:
+            resp = proto.responsefor(pkt, proto.SERVFAIL)
+        try:
+            if pkt.cachever is not None and resp.tsigctx is None and resp.rescode in (0, proto.NXDOMAIN):
+                zone, version = pkt.cachever
+                if zone.handler.cacheable:
+                    data = self.anscache.store(pkt.cachekey, resp, zone, version)
+                    if data is not None:
+                        sender.senddata(data)
+                        return
+            sender.send(resp)
+        except (proto.malformedpacket, rec.malformedrr), inst:
+            # Lazily decoded data in the response, copied from elsewhere
+            logger.warning("could not encode the response to %04x: %s", pkt.qid, inst)
+            sender.send(proto.responsefor(pkt, proto.SERVFAIL))
+
+    def deadlinefor(self, zone):
+        if zone.deadline is not None:
+            return zone.deadline
+        if zone.handler.deadline is not None:
+            return zone.handler.deadline
+        return self.deadline
+
+    def expire(self, pkt, sender):
+        logger.debug("request %04x expired in queue", pkt.qid)
+        self.expirecount += 1
+        if self.onexpire == "servfail":
+            sender.send(proto.responsefor(pkt, proto.SERVFAIL))
+        else:
+            sender.drop()
+
     def addsock(self, af, socket):
         self.sockets += [(af, socket)]
+        if self.listener is not None:
+            self.listener.addsock(af, socket)
+
+    def addtcpsock(self, af, socket):
+        self.tcpsockets += [(af, socket)]
+        if self.listener is not None:
+            self.listener.addtcpsock(af, socket)
+
+    def rmsock(self, socket):
+        self.sockets = [(af, sk) for af, sk in self.sockets if sk is not socket]
+        self.tcpsockets = [(af, sk) for af, sk in self.tcpsockets if sk is not socket]
+        if self.listener is not None:
+            self.listener.rmsock(socket)
 
     def addzone(self, zone):
         self.zones += [zone]
+        # Lanes that zones name are made on demand, with the same budget
+        # as the default lane: 1000 queued requests and 10 to 100
+        # dispatchers, which setup() may tune through self.lanes.
+        name = self.zonelane(zone)
+        if name is not None:
+            self.addlane(name)
+        index = self.zoneindex[zone.origin.rooted]
+        if zone.origin not in index:
+            index.add(zone.origin, zone)
+
+    def rmzone(self, zone):
+        self.zones = [z for z in self.zones if z is not zone]
+        index = self.zoneindex[zone.origin.rooted]
+        if index.get(zone.origin) is zone:
+            for z in self.zones:
+                if z.origin == zone.origin:
+                    index.add(z.origin, z)
+                    break
+            else:
+                index.remove(zone.origin)
+
+    def addlane(self, name):
+        if name in self.lanes:
+            return self.lanes[name]
+        lane = dnsserver.lane(self, name)
+        self.lanes[name] = lane
+        if self.running:
+            lane.start()
+        return lane
+
+    def zonelane(self, zone):
+        if zone.lane is not None:
+            return zone.lane
+        return zone.handler.lane
+
+    def lanefor(self, pkt):
+        if len(pkt.qlist) > 0:
+            zone = self.findzone(pkt.qlist[0].name)
+            if zone is not None:
+                name = self.zonelane(zone)
+                if name in self.lanes:
+                    return self.lanes[name]
+        return self.deflane
 
     def queuereq(self, req, sender):
-        self.queuelock.acquire()
-        self.queue += [(time.time(), req, sender)]
-        logger.debug("queue length+: %i", len(self.queue))
-        self.queuelock.notify()
-        self.queuelock.release()
-
-    def dequeuereq(self):
-        self.queuelock.acquire()
-        if len(self.queue) == 0:
-            self.queuelock.wait()
-        if len(self.queue) > 0:
-            ret = self.queue[0]
-            self.queue = self.queue[1:]
-        else:
-            ret = None
-        logger.debug("queue length-: %i", len(self.queue))
-        self.queuelock.release()
-        if ret is None:
-            return None
-        else:
-            return ret[1:]
+        self.queuereqs([(req, sender)])
+
+    def queuereqs(self, reqs):
+        now = time.time()
+        bylane = {}
+        for req, sender in reqs:
+            req.qtime = now
+            if self.engine == "events" and self.listener is not None and self.iscoro(req):
+                self.spawnreq(req, sender)
+                continue
+            lane = self.lanefor(req)
+            if lane not in bylane:
+                bylane[lane] = []
+            bylane[lane].append((req, sender))
+        for lane, lreqs in bylane.items():
+            lane.queuereqs(lreqs, now)
+
+    def poolstats(self):
+        return dict([(name, lane.poolstats()) for name, lane in self.lanes.items()])
+
+    def stats(self):
+        ret = {"expired": self.expirecount}
+        if self.listener is not None:
+            ret.update(self.listener.stats())
+        for lane in self.lanes.values():
+            st = lane.poolstats()
+            for key in ["dispatchers", "busy", "queued"]:
+                ret[key] = ret.get(key, 0) + st[key]
+            for key, val in lane.overflowcount.items():
+                ret[key] = ret.get(key, 0) + val
+        if self.anscache is not None:
+            for key, val in self.anscache.stats().items():
+                ret["cache" + key] = val
+        return ret
 
     def start(self):
         if self.running:
@@ -190,10 +1117,8 @@ class dnsserver:
         lst = dnsserver.socklistener(self)
         self.listener = lst
         lst.start()
-        for i in xrange(10):
-            newdsp = dnsserver.dispatcher(self)
-            self.dispatchers += [newdsp]
-            newdsp.start()
+        for lane in self.lanes.values():
+            lane.start()
         self.running = True
         self.monitor = dnsserver.queuemonitor(self)
         self.monitor.start()
@@ -202,14 +1127,8 @@ class dnsserver:
         self.listener.stop()
         self.listener.join()
         self.listener = None
-        for dsp in self.dispatchers:
-            dsp.alive = False
-        self.queuelock.acquire()
-        self.queuelock.notifyAll()
-        self.queuelock.release()
-        for dsp in self.dispatchers + []:
-            dsp.join()
-            self.dispatchers.remove(dsp)
+        for lane in self.lanes.values():
+            lane.stop()
         self.running = False
         self.monitor = None
 
@@ -226,22 +1145,29 @@ class dnsserver:
         return myres(self, addr)
 
 class zone:
-    def __init__(self, origin, handler):
+    def __init__(self, origin, handler, deadline = None, lane = None):
         if type(origin) == str:
-            self.origin = dn.fromstring(origin)
-            self.origin.rooted = True
+            self.origin = dn.domainname(dn.fromstring(origin).parts, True)
         else:
             self.origin = origin
         self.handler = handler
+        self.deadline = deadline
+        self.lane = lane
 
     def handle(self, query, pkt):
         resp = self.handler.handle(query, pkt, self.origin)
         return resp
 
+    def handlegen(self, query, pkt):
+        return self.handler.handlegen(query, pkt, self.origin)
+
 class authzone(zone):
-    def __init__(self, aurecres, *args):
+    # The authority processing below is synchronous
+    handlegen = None
+
+    def __init__(self, aurecres, *args, **kwargs):
         self.aurecres = aurecres
-        zone.__init__(self, *args)
+        zone.__init__(self, *args, **kwargs)
 
     def handle(self, query, pkt):
         resp = zone.handle(self, query, pkt)
@@ -252,12 +1178,12 @@ class authzone(zone):
                 resp.aulist += soa.anlist
                 resp.rescode = proto.NXDOMAIN
             else:
-                resolver.resolvecnames(resp, self.aurecres)
+                resolver.resolvecnames(resp, self.aurecres, pkt.deadline)
                 nsrecs = zone.handle(self, rec.rrhead(self.origin, "NS"), pkt)
                 if nsrecs is not None:
                     resp.aulist += nsrecs.anlist
                     for rr in nsrecs.anlist:
-                        resolver.resolveadditional(resp, rr, self.aurecres)
+                        resolver.resolveadditional(resp, rr, self.aurecres, pkt.deadline)
         else:
             if resp is None:
                 return None
@@ -265,10 +1191,26 @@ class authzone(zone):
         return resp
 
 class handler:
+    deadline = None
+    lane = None
+    # Whether the server's answer cache may store the responses; false
+    # for handlers whose answers depend on more than the question.
+    cacheable = True
+    # Handlers whose data may be changed by others, such as other
+    # lddd workers, define generation() to return a value that changes
+    # when it does; the answer cache checks it every second.
+    generation = None
+    # Coroutine handlers define handlegen(query, pkt, origin) as a
+    # generator; when the server runs the "events" engine, they are
+    # run on the listener's event loop instead of a dispatcher.
+    handlegen = None
+
     def handle(self, query, pkt, origin):
         return None
 
 class forwarder(handler):
+    lane = "recurse"
+
     def __init__(self, nameserver, timeout = 2000, retries = 3):
         self.nameserver = nameserver
         self.timeout = timeout
@@ -280,17 +1222,55 @@ class forwarder(handler):
         p = select.poll()
         p.register(sk.fileno(), select.POLLIN)
         for i in range(self.retries):
+            timeout = self.timeout
+            if pkt.deadline is not None:
+                left = int((pkt.deadline - time.time()) * 1000)
+                if left <= 0:
+                    return None
+                timeout = min(timeout, left)
             sk.sendto(pkt.encode(), self.nameserver[1:])
-            fds = p.poll(self.timeout)
+            fds = p.poll(timeout)
             if (sk.fileno(), select.POLLIN) in fds:
                 break
         else:
             return None
         resp = sk.recv(65536)
-        resp = proto.decodepacket(resp)
+        try:
+            resp = proto.decodepacket(resp)
+        except (proto.malformedpacket, rec.malformedrr):
+            return None
         return resp
+
+    def handlegen(self, query, pkt, origin):
+        sk = socket.socket(self.nameserver[0], socket.SOCK_DGRAM)
+        try:
+            sk.setblocking(0)
+            sk.bind(("", 0))
+            for i in range(self.retries):
+                timeout = self.timeout
+                if pkt.deadline is not None:
+                    left = int((pkt.deadline - time.time()) * 1000)
+                    if left <= 0:
+                        yield result(None)
+                    timeout = min(timeout, left)
+                sk.sendto(pkt.encode(), self.nameserver[1:])
+                ready = yield readable(sk, timeout / 1000.0)
+                if ready:
+                    break
+            else:
+                yield result(None)
+            resp = sk.recv(65536)
+            try:
+                resp = proto.decodepacket(resp)
+            except (proto.malformedpacket, rec.malformedrr):
+                resp = None
+            yield result(resp)
+        finally:
+            sk.close()
     
 class recurser(handler):
+    lane = "recurse"
+
     def __init__(self, resolver):
         self.resolver = resolver
 
@@ -304,9 +1284,14 @@ class recurser(handler):
 class chain(handler):
     def __init__(self, chain):
         self.chain = chain
+        self.cacheable = False not in [h.cacheable for h in chain]
 
     def add(self, handler):
         self.chain += [handler]
+        self.cacheable = self.cacheable and handler.cacheable
+
+    def generation(self):
+        return tuple([h.generation() for h in self.chain if h.generation is not None])
     
     def handle(self, *args):
         for h in self.chain: